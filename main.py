@@ -1,261 +1,366 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, stream_with_context
 from functools import wraps
+import hashlib
+import logging
+import secrets
+import threading
 import time
 
-from managers.ai_manager import ai_manager
+from managers.ai_manager import get_ai_manager
 from managers.prompt_manager import prompt_manager
 from managers.conversation_manager import conversation_manager
 from managers.message_manager import message_manager
+from utils import json_util
 from utils.api_key_util import key_manager
 from utils.response_utils import ResponseUtil
 from utils.logger import logger
 
 app = Flask(__name__)
 
+# 已验证密钥缓存: 密钥哈希 -> 过期时间(monotonic), 只缓存验证成功的密钥
+# 用进程级随机盐的BLAKE2b哈希作键，内存里不留明文密钥
+_PROCESS_SALT = secrets.token_bytes(16)
+_validation_cache: dict[bytes, float] = {}
+_validation_lock = threading.Lock()
+_CACHE_TTL = 300
+_CACHE_MAX_SIZE = 1024
+
+
+def _key_hash(api_key: str) -> bytes:
+    """计算密钥的带盐哈希"""
+    return hashlib.blake2b(api_key.encode(), digest_size=16, key=_PROCESS_SALT).digest()
+
+
+def invalidate(api_key: str = None):
+    """使密钥缓存失效, 不传参数则清空全部(密钥轮换时调用)"""
+    with _validation_lock:
+        if api_key is None:
+            _validation_cache.clear()
+        else:
+            _validation_cache.pop(_key_hash(api_key), None)
+
+
+# 密钥一变就清空缓存，旧密钥(包括大小写/横杠不同的写法)不能再靠缓存通过验证
+key_manager.on_change(invalidate)
+
+
+def _is_cached_valid(key_hash: bytes) -> bool:
+    """密钥是否在缓存中且未过期"""
+    expire_at = _validation_cache.get(key_hash)
+    return expire_at is not None and expire_at > time.monotonic()
+
+
+def _cache_valid_key(key_hash: bytes):
+    """缓存验证成功的密钥, 超出上限时淘汰最早写入的条目"""
+    with _validation_lock:
+        _validation_cache.pop(key_hash, None)
+        _validation_cache[key_hash] = time.monotonic() + _CACHE_TTL
+        while len(_validation_cache) > _CACHE_MAX_SIZE:
+            del _validation_cache[next(iter(_validation_cache))]
+
+
+# 列表接口的响应体缓存: 接口名 -> (数据版本, 响应体)
+_list_response_cache: dict[str, tuple[int, bytes]] = {}
+
+
+def _cached_list_response(name: str, version: int, build) -> tuple:
+    """数据版本没变时直接复用上次序列化好的响应体"""
+    cached = _list_response_cache.get(name)
+    if cached is None or cached[0] != version:
+        cached = (version, ResponseUtil.success_body(build()))
+        _list_response_cache[name] = cached
+    return ResponseUtil.raw(cached[1])
+
+
+def _get_json_body() -> dict | None:
+    """解析JSON请求体，为空、格式错误或不是对象时返回None"""
+    body = request.get_data(cache=False)
+    if not body:
+        return None
+
+    try:
+        data = json_util.loads(body)
+    except ValueError:
+        return None
+
+    return data if isinstance(data, dict) else None
+
 
 # API密钥验证装饰器
 def require_api_key(func):
     """API密钥验证装饰器 - 同时支持Header和Query参数"""
 
+    # 每个请求都会走这里，把用到的全局对象绑定成闭包变量，省去逐次的全局查找
+    _request = request
+    _logger = logger
+    key_hash_of = _key_hash
+    is_cached_valid = _is_cached_valid
+    cache_valid_key = _cache_valid_key
+    validate = key_manager.validate
+    error = ResponseUtil.error
+
     @wraps(func)
     def decorated_function(*args, **kwargs):
         # 优先级：Header > Query参数
-        api_key = (
-                request.headers.get('X-API-Key') or
-                request.args.get('key') or
-                request.args.get('api_key')
-        )
+        # 直接查environ，跳过Headers包装的大小写无关查找
+        api_key = _request.environ.get('HTTP_X_API_KEY')
+        if not api_key:
+            query = _request.args
+            api_key = query.get('key') or query.get('api_key')
 
         if not api_key:
-            logger.warning("API请求缺少密钥")
-            return ResponseUtil.error(403)
+            _logger.warning("API请求缺少密钥")
+            return error(403)
+
+        # 命中缓存直接放行
+        key_hash = key_hash_of(api_key)
+        if is_cached_valid(key_hash):
+            return func(*args, **kwargs)
 
-        if not key_manager.validate(api_key):
-            logger.warning(f"API密钥验证失败: {api_key[:8]}...")
-            return ResponseUtil.error(403)
+        if not validate(api_key):
+            _logger.warning("API密钥验证失败: %s...", api_key[:8])
+            return error(403)
 
-        logger.info(f"API密钥验证成功: {api_key[:8]}...")
+        cache_valid_key(key_hash)
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info("API密钥验证成功: %s...", api_key[:8])
         return func(*args, **kwargs)
 
     return decorated_function
 
 
+# 路由异常处理装饰器
+def api_route(action: str):
+    """统一捕获路由中的异常，记录日志并返回500"""
+
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                logger.exception("%s失败: %s", action, e)
+                return ResponseUtil.error(500, str(e))
+
+        return decorated_function
+
+    return decorator
+
+
 # ==================== Prompt相关路由 ====================
 
 @app.route('/v1/prompt/set', methods=['POST'])
+@api_route("设置提示词")
 @require_api_key
 def set_prompt():
     """
     创建或更新提示词
     """
-    try:
-        data = request.get_json()
-        if not data:
-            return ResponseUtil.error(400, "请求体不能为空")
+    data = _get_json_body()
+    if not data:
+        return ResponseUtil.error(400, "请求体不能为空")
 
-        name = data.get('name')
-        value = data.get('value')
+    name = data.get('name')
+    value = data.get('value')
 
-        if not name or not value:
-            return ResponseUtil.error(400, "name和value字段不能为空")
+    if not name or not value:
+        return ResponseUtil.error(400, "name和value字段不能为空")
 
-        success = prompt_manager.set_prompt(name, value)
+    success = prompt_manager.set_prompt(name, value)
 
-        if success:
-            return ResponseUtil.success({"message": "提示词设置成功", "name": name})
-        else:
-            return ResponseUtil.error(500, "保存提示词失败")
-
-    except Exception as e:
-        logger.error(f"设置提示词失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    if success:
+        return ResponseUtil.success({"message": "提示词设置成功", "name": name})
+    else:
+        return ResponseUtil.error(500, "保存提示词失败")
 
 
 @app.route('/v1/prompt/create', methods=['POST'])
+@api_route("创建提示词")
 @require_api_key
 def create_prompt():
     """
     创建新的提示词（不允许覆盖已存在的）
     """
-    try:
-        data = request.get_json()
-        if not data:
-            return ResponseUtil.error(400, "请求体不能为空")
-
-        name = data.get('name')
-        value = data.get('value')
+    data = _get_json_body()
+    if not data:
+        return ResponseUtil.error(400, "请求体不能为空")
 
-        if not name or not value:
-            return ResponseUtil.error(400, "name和value字段不能为空")
+    name = data.get('name')
+    value = data.get('value')
 
-        existing = prompt_manager.get_prompt(name)
-        if existing:
-            return ResponseUtil.error(400, f"提示词 '{name}' 已存在")
+    if not name or not value:
+        return ResponseUtil.error(400, "name和value字段不能为空")
 
-        success = prompt_manager.set_prompt(name, value)
+    existing = prompt_manager.get_prompt(name)
+    if existing:
+        return ResponseUtil.error(400, f"提示词 '{name}' 已存在")
 
-        if success:
-            return ResponseUtil.success({"message": "提示词创建成功", "name": name})
-        else:
-            return ResponseUtil.error(500, "创建提示词失败")
+    success = prompt_manager.set_prompt(name, value)
 
-    except Exception as e:
-        logger.error(f"创建提示词失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    if success:
+        return ResponseUtil.success({"message": "提示词创建成功", "name": name})
+    else:
+        return ResponseUtil.error(500, "创建提示词失败")
 
 
 @app.route('/v1/prompt/get', methods=['GET', 'POST'])
+@api_route("获取提示词")
 @require_api_key
 def get_prompt():
     """
     获取提示词
     """
-    try:
-        if request.method == 'GET':
-            name = request.args.get('name')
-        else:
-            data = request.get_json() or {}
-            name = data.get('name')
-
-        if not name:
-            return ResponseUtil.error(400, "name参数不能为空")
+    if request.method == 'GET':
+        name = request.args.get('name')
+    else:
+        data = _get_json_body() or {}
+        name = data.get('name')
 
-        prompt_value = prompt_manager.get_prompt(name)
+    if not name:
+        return ResponseUtil.error(400, "name参数不能为空")
 
-        if not prompt_value:
-            return ResponseUtil.error(404, f"提示词 '{name}' 不存在")
+    prompt_value = prompt_manager.get_prompt(name)
 
-        return ResponseUtil.success({
-            "name": name,
-            "value": prompt_value
-        })
+    if not prompt_value:
+        return ResponseUtil.error(404, f"提示词 '{name}' 不存在")
 
-    except Exception as e:
-        logger.error(f"获取提示词失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    return ResponseUtil.success({
+        "name": name,
+        "value": prompt_value
+    })
 
 
 @app.route('/v1/prompt/list', methods=['GET'])
+@api_route("列出提示词")
 @require_api_key
 def list_prompts():
     """
     列出所有提示词
     """
-    try:
+    def build():
         prompts = prompt_manager.list_prompts()
 
         formatted_prompts = {}
         for name, data in prompts.items():
             formatted_prompts[name] = data.get("prompt", "")
+        return formatted_prompts
 
-        return ResponseUtil.success(formatted_prompts)
-
-    except Exception as e:
-        logger.error(f"列出提示词失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    return _cached_list_response("prompt", prompt_manager.version, build)
 
 
 # ==================== AI配置相关路由 ====================
 
+# AI配置的必填字段
+_AI_REQUIRED_FIELDS = frozenset({'name', 'api_key', 'provider', 'model'})
+
+
 @app.route('/v1/ai/list', methods=['GET'])
+@api_route("列出AI配置")
 @require_api_key
 def list_ais():
     """
     列出所有AI配置
     """
-    try:
-        ais = ai_manager.list()
-        return ResponseUtil.success(ais)
-    except Exception as e:
-        logger.error(f"列出AI配置失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    manager = get_ai_manager()
+    return _cached_list_response("ai", manager.version, manager.list)
 
 
 @app.route('/v1/ai/get', methods=['GET'])
+@api_route("获取AI配置")
 @require_api_key
 def get_ai():
     """
     获取单个AI配置
     """
-    try:
-        uuid = request.args.get('uuid')
-        if not uuid:
-            return ResponseUtil.error(400, "uuid参数不能为空")
+    uuid = request.args.get('uuid')
+    if not uuid:
+        return ResponseUtil.error(400, "uuid参数不能为空")
 
-        ai_config = ai_manager.get(uuid)
-        if not ai_config:
-            return ResponseUtil.error(404, f"AI配置 '{uuid}' 不存在")
+    ai_config = get_ai_manager().get(uuid)
+    if not ai_config:
+        return ResponseUtil.error(404, f"AI配置 '{uuid}' 不存在")
 
-        return ResponseUtil.success(ai_config)
-    except Exception as e:
-        logger.error(f"获取AI配置失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    return ResponseUtil.success(ai_config)
 
 
 @app.route('/v1/ai/set', methods=['POST'])
+@api_route("设置AI配置")
 @require_api_key
 def set_ai():
     """
     设置AI配置
     """
-    try:
-        data = request.get_json()
-        if not data:
-            return ResponseUtil.error(400, "请求体不能为空")
+    data = _get_json_body()
+    if not data:
+        return ResponseUtil.error(400, "请求体不能为空")
 
-        uuid = data.get('uuid')
-        config = data.get('config')
+    uuid = data.get('uuid')
+    config = data.get('config')
 
-        if not uuid or not config:
-            return ResponseUtil.error(400, "uuid和config字段不能为空")
+    if not uuid or not config:
+        return ResponseUtil.error(400, "uuid和config字段不能为空")
 
-        required_fields = ['name', 'api_key', 'provider', 'model']
-        for field in required_fields:
-            if field not in config:
-                return ResponseUtil.error(400, f"config中缺少必要字段: {field}")
+    if not isinstance(config, dict):
+        return ResponseUtil.error(422, "config必须是对象")
 
-        success = ai_manager.set(uuid, config)
+    missing = _AI_REQUIRED_FIELDS - config.keys()
+    if missing:
+        return ResponseUtil.error(400, f"config中缺少必要字段: {', '.join(sorted(missing))}")
 
-        if success:
-            return ResponseUtil.success({"message": "AI配置设置成功", "uuid": uuid})
-        else:
-            return ResponseUtil.error(500, "保存AI配置失败")
+    success = get_ai_manager().set(uuid, config)
 
-    except Exception as e:
-        logger.error(f"设置AI配置失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    if success:
+        return ResponseUtil.success({"message": "AI配置设置成功", "uuid": uuid})
+    else:
+        return ResponseUtil.error(500, "保存AI配置失败")
 
 
 @app.route('/v1/ai/delete', methods=['POST'])
+@api_route("删除AI配置")
 @require_api_key
 def delete_ai():
     """
     删除AI配置
     """
-    try:
-        data = request.get_json()
-        if not data:
-            return ResponseUtil.error(400, "请求体不能为空")
+    data = _get_json_body()
+    if not data:
+        return ResponseUtil.error(400, "请求体不能为空")
 
-        uuid = data.get('uuid')
-        if not uuid:
-            return ResponseUtil.error(400, "uuid字段不能为空")
+    uuid = data.get('uuid')
+    if not uuid:
+        return ResponseUtil.error(400, "uuid字段不能为空")
 
-        success = ai_manager.delete(uuid)
+    success = get_ai_manager().delete(uuid)
 
-        if success:
-            return ResponseUtil.success({"message": "AI配置删除成功", "uuid": uuid})
-        else:
-            return ResponseUtil.error(404, f"AI配置 '{uuid}' 不存在或删除失败")
+    if success:
+        return ResponseUtil.success({"message": "AI配置删除成功", "uuid": uuid})
+    else:
+        return ResponseUtil.error(404, f"AI配置 '{uuid}' 不存在或删除失败")
 
-    except Exception as e:
-        logger.error(f"删除AI配置失败: {e}")
-        return ResponseUtil.error(500, str(e))
+
+# ==================== 密钥管理 ====================
+
+@app.route('/v1/key/rotate', methods=['POST'])
+@api_route("更换API密钥")
+@require_api_key
+def rotate_key():
+    """
+    更换API密钥，旧密钥（包括已缓存的验证结果）立即失效
+    """
+    new_key = key_manager.rotate()
+    return ResponseUtil.success({"message": "API密钥已更换", "api_key": new_key})
 
 
 # ==================== 聊天对话相关路由 ====================
 
+def _sse(events):
+    """把事件转成Server-Sent Events格式"""
+    for event in events:
+        yield b"data: " + json_util.dumps(event) + b"\n\n"
+
+
 @app.route('/v1/chat/send', methods=['POST'])
+@api_route("发送聊天消息")
 @require_api_key
 def send_chat():
     """
@@ -269,53 +374,52 @@ def send_chat():
             "tool_call_id": "call_123",
             "content": "工具执行结果JSON"
         },
-        "tools": [...]
+        "tools": [...],
+        "stream": false
     }
+    stream为true时以text/event-stream逐块返回
     """
-    try:
-        data = request.get_json()
-        if not data:
-            return ResponseUtil.error(400, "请求体不能为空")
+    data = _get_json_body()
+    if not data:
+        return ResponseUtil.error(400, "请求体不能为空")
 
-        # 必需字段验证
-        conversation = data.get('conversation')
-        device = data.get('device')
+    # 必需字段验证
+    conversation = data.get('conversation')
+    device = data.get('device')
 
-        if not conversation or not device:
-            return ResponseUtil.error(400, "conversation和device字段不能为空")
+    if not conversation or not device:
+        return ResponseUtil.error(400, "conversation和device字段不能为空")
 
-        # 调用消息管理器处理
-        result = message_manager.process_message(data)
+    # 流式返回: 以Server-Sent Events逐块推送AI回复
+    if data.get('stream'):
+        events = _sse(message_manager.stream_message(data))
+        return Response(stream_with_context(events), mimetype='text/event-stream')
 
-        if result.get('success'):
-            return ResponseUtil.success(result.get('response'))
-        else:
-            return ResponseUtil.error(500, result.get('error', '未知错误'))
+    # 调用消息管理器处理
+    result = message_manager.process_message(data)
 
-    except Exception as e:
-        logger.error(f"发送聊天消息失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    if result.get('success'):
+        return ResponseUtil.success(result.get('response'))
+    else:
+        return ResponseUtil.error(500, result.get('error', '未知错误'))
 
 
 @app.route('/v1/chat/list', methods=['GET'])
+@api_route("列出聊天会话")
 @require_api_key
 def list_chats():
     """
     列出所有聊天会话
     GET /v1/chat/list?device=xxx
     """
-    try:
-        device_id = request.args.get('device')
-
-        conversations = conversation_manager.list_conversations(device_id)
-        return ResponseUtil.success(conversations)
+    device_id = request.args.get('device')
 
-    except Exception as e:
-        logger.error(f"列出聊天会话失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    conversations = conversation_manager.list_conversations(device_id)
+    return ResponseUtil.success(conversations)
 
 
 @app.route('/v1/history/get', methods=['GET', 'POST'])
+@api_route("获取聊天历史")
 @require_api_key
 def get_history():
     """
@@ -328,86 +432,78 @@ def get_history():
         "lines": 20
     }
     """
-    try:
-        if request.method == 'GET':
-            uuid = request.args.get('uuid')
-            tactical = request.args.get('tactical', 'false').lower() == 'true'
-            lines = request.args.get('lines', type=int)
-        else:
-            data = request.get_json() or {}
-            uuid = data.get('uuid')
-            tactical = data.get('tactical', False)
-            lines = data.get('lines')
-
-        if not uuid:
-            return ResponseUtil.error(400, "uuid参数不能为空")
-
-        # 获取对话上下文
-        context_data = conversation_manager.get_conversation_context(uuid)
-        if not context_data:
-            return ResponseUtil.error(404, f"对话 '{uuid}' 不存在")
-
-        response_data = {
-            "metadata": context_data["metadata"],
-            "tactical": context_data.get("tactical", []),
-            "archive": context_data.get("archive", []),
-            "raw_context": context_data.get("raw_context", [])
-        }
-
-        # 如果指定了lines，只返回最近lines条
-        if lines and lines > 0:
-            response_data["tactical"] = response_data["tactical"][-lines:]
-            response_data["raw_context"] = response_data["raw_context"][-lines:]
+    if request.method == 'GET':
+        uuid = request.args.get('uuid')
+        tactical = request.args.get('tactical', 'false').lower() == 'true'
+        lines = request.args.get('lines', type=int)
+    else:
+        data = _get_json_body() or {}
+        uuid = data.get('uuid')
+        tactical = data.get('tactical', False)
+        lines = data.get('lines')
+
+    if not uuid:
+        return ResponseUtil.error(400, "uuid参数不能为空")
+
+    # 获取对话上下文
+    context_data = conversation_manager.get_conversation_context(uuid)
+    if not context_data:
+        return ResponseUtil.error(404, f"对话 '{uuid}' 不存在")
+
+    response_data = {
+        "metadata": context_data["metadata"],
+        "tactical": context_data.get("tactical", []),
+        "archive": context_data.get("archive", []),
+        "raw_context": context_data.get("raw_context", [])
+    }
 
-        # 如果只需要tactical
-        if tactical:
-            return ResponseUtil.success({
-                "tactical": response_data["tactical"],
-                "message_count": context_data["metadata"].get("message_count", 0)
-            })
+    # 如果指定了lines，只返回最近lines条
+    if lines and lines > 0:
+        response_data["tactical"] = response_data["tactical"][-lines:]
+        response_data["raw_context"] = response_data["raw_context"][-lines:]
 
-        return ResponseUtil.success(response_data)
+    # 如果只需要tactical
+    if tactical:
+        return ResponseUtil.success({
+            "tactical": response_data["tactical"],
+            "message_count": context_data["metadata"].get("message_count", 0)
+        })
 
-    except Exception as e:
-        logger.error(f"获取聊天历史失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    return ResponseUtil.success(response_data)
 
 
 @app.route('/v1/history/memory', methods=['GET'])
+@api_route("获取记忆列表")
 @require_api_key
 def get_memory():
     """
     获取记忆列表（archive内容）
     GET /v1/history/memory?uuid=xxx
     """
-    try:
-        uuid = request.args.get('uuid')
-        if not uuid:
-            return ResponseUtil.error(400, "uuid参数不能为空")
+    uuid = request.args.get('uuid')
+    if not uuid:
+        return ResponseUtil.error(400, "uuid参数不能为空")
 
-        context_data = conversation_manager.get_conversation_context(uuid)
-        if not context_data:
-            return ResponseUtil.error(404, f"对话 '{uuid}' 不存在")
+    context_data = conversation_manager.get_conversation_context(uuid)
+    if not context_data:
+        return ResponseUtil.error(404, f"对话 '{uuid}' 不存在")
 
-        archive = context_data.get("archive", [])
+    archive = context_data.get("archive", [])
 
-        # 提取压缩记忆的内容
-        memories = []
-        for item in archive:
-            if isinstance(item, dict) and item.get("type") == "compressed":
-                memories.append(item.get("content", ""))
+    # 提取压缩记忆的内容
+    memories = []
+    for item in archive:
+        if isinstance(item, dict) and item.get("type") == "compressed":
+            memories.append(item.get("content", ""))
 
-        return ResponseUtil.success({
-            "memories": memories,
-            "count": len(memories)
-        })
-
-    except Exception as e:
-        logger.error(f"获取记忆列表失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    return ResponseUtil.success({
+        "memories": memories,
+        "count": len(memories)
+    })
 
 
 @app.route('/v1/create', methods=['POST'])
+@api_route("创建聊天会话")
 @require_api_key
 def create_chat():
     """
@@ -420,49 +516,45 @@ def create_chat():
         "device": "设备ID"
     }
     """
-    try:
-        data = request.get_json()
-        if not data:
-            return ResponseUtil.error(400, "请求体不能为空")
-
-        name = data.get('name')
-        prompt_type = data.get('prompt')
-        ai_uuid = data.get('ai')
-        device_id = data.get('device')
-
-        if not name or not prompt_type or not ai_uuid or not device_id:
-            return ResponseUtil.error(400, "name、prompt、ai、device字段不能为空")
-
-        # 验证AI配置存在
-        ai_config = ai_manager.get(ai_uuid)
-        if not ai_config:
-            return ResponseUtil.error(404, f"AI配置 '{ai_uuid}' 不存在")
-
-        # 验证提示词存在
-        prompt_value = prompt_manager.get_prompt(prompt_type)
-        if not prompt_value:
-            return ResponseUtil.error(404, f"提示词 '{prompt_type}' 不存在")
-
-        # 创建对话
-        conversation_id = conversation_manager.create_conversation(
-            name=name,
-            prompt_type=prompt_type,
-            ai_uuid=ai_uuid,
-            device_id=device_id
-        )
-
-        return ResponseUtil.success({
-            "conversation_id": conversation_id,
-            "name": name,
-            "message": "对话创建成功"
-        })
-
-    except Exception as e:
-        logger.error(f"创建聊天会话失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    data = _get_json_body()
+    if not data:
+        return ResponseUtil.error(400, "请求体不能为空")
+
+    name = data.get('name')
+    prompt_type = data.get('prompt')
+    ai_uuid = data.get('ai')
+    device_id = data.get('device')
+
+    if not name or not prompt_type or not ai_uuid or not device_id:
+        return ResponseUtil.error(400, "name、prompt、ai、device字段不能为空")
+
+    # 验证AI配置存在
+    ai_config = get_ai_manager().get(ai_uuid)
+    if not ai_config:
+        return ResponseUtil.error(404, f"AI配置 '{ai_uuid}' 不存在")
+
+    # 验证提示词存在
+    prompt_value = prompt_manager.get_prompt(prompt_type)
+    if not prompt_value:
+        return ResponseUtil.error(404, f"提示词 '{prompt_type}' 不存在")
+
+    # 创建对话
+    conversation_id = conversation_manager.create_conversation(
+        name=name,
+        prompt_type=prompt_type,
+        ai_uuid=ai_uuid,
+        device_id=device_id
+    )
+
+    return ResponseUtil.success({
+        "conversation_id": conversation_id,
+        "name": name,
+        "message": "对话创建成功"
+    })
 
 
 @app.route('/v1/delete', methods=['POST'])
+@api_route("删除聊天会话")
 @require_api_key
 def delete_chat():
     """
@@ -472,39 +564,37 @@ def delete_chat():
         "uuid": "对话UUID"
     }
     """
-    try:
-        data = request.get_json()
-        if not data:
-            return ResponseUtil.error(400, "请求体不能为空")
+    data = _get_json_body()
+    if not data:
+        return ResponseUtil.error(400, "请求体不能为空")
 
-        uuid = data.get('uuid')
-        if not uuid:
-            return ResponseUtil.error(400, "uuid字段不能为空")
-
-        success = conversation_manager.delete_conversation(uuid)
+    uuid = data.get('uuid')
+    if not uuid:
+        return ResponseUtil.error(400, "uuid字段不能为空")
 
-        if success:
-            return ResponseUtil.success({"message": "对话删除成功", "uuid": uuid})
-        else:
-            return ResponseUtil.error(404, f"对话 '{uuid}' 不存在或删除失败")
+    success = conversation_manager.delete_conversation(uuid)
 
-    except Exception as e:
-        logger.error(f"删除聊天会话失败: {e}")
-        return ResponseUtil.error(500, str(e))
+    if success:
+        return ResponseUtil.success({"message": "对话删除成功", "uuid": uuid})
+    else:
+        return ResponseUtil.error(404, f"对话 '{uuid}' 不存在或删除失败")
 
 
 # ==================== 健康检查 ====================
 
+# 健康检查响应只有时间戳会变，其余部分预先拼好
+_HEALTH_PREFIX = b'{"status":"healthy","version":"v1.0.0","timestamp":'
+_HEALTH_SUFFIX = b'}'
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查端点"""
-    return jsonify({
-        "status": "healthy",
-        "timestamp": time.time(),
-        "version": "v1.0.0"
-    })
+    body = _HEALTH_PREFIX + repr(time.time()).encode() + _HEALTH_SUFFIX
+    return Response(body, mimetype='application/json')
 
 
 if __name__ == '__main__':
 
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # 每个请求一个线程，等待AI回复时不会卡住其他请求
+    app.run(debug=True, port=5000, threaded=True)
\ No newline at end of file
@@ -1,8 +1,25 @@
-import json
+import atexit
+import mmap
+import threading
 from pathlib import Path
+from types import MappingProxyType
+from utils import json_util, llm_cache
+from utils.file_utils import ensure_dir, write_atomic
 from utils.logger import logger
-import requests
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Dict, Iterator, Optional
+
+if TYPE_CHECKING:
+    import requests
+
+
+# ai.json超过这个大小时用mmap读取，省去一次整文件拷贝
+MMAP_THRESHOLD = 64 * 1024
+
+# 修改后延迟多久写盘，期间的多次修改合并为一次写入
+SAVE_DELAY = 0.2
+
+# 每个上游地址保持的keep-alive连接数，AI配置里的pool_maxsize可以覆盖
+POOL_MAXSIZE = 128
 
 
 class AIConfigManager:
@@ -10,43 +27,88 @@ class AIConfigManager:
 
     def __init__(self, config_dir: str = "data"):
         self.config_dir = Path(config_dir)
-        self.config_dir.mkdir(parents=True, exist_ok=True)
+        ensure_dir(str(self.config_dir))
 
         self.ai_file = self.config_dir / "ai.json"
         self.ais = self._load_ai()
+        self._ais_view = MappingProxyType(self.ais)
+        # 每次修改+1，用于判断缓存是否过期
+        self.version = 0
+
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        atexit.register(self._flush)
+
+        # 连接池大小 -> 复用连接的Session，不用每次请求都重新握手
+        self._sessions: Dict[int, "requests.Session"] = {}
+        # id(AI配置) -> (AI配置, 请求地址, 请求头)，修改配置时清空
+        self._targets: Dict[int, tuple] = {}
 
     def _load_ai(self) -> dict:
         if not self.ai_file.exists():
             return {}
 
         try:
-            with open(self.ai_file, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(self.ai_file, "rb") as f:
+                if self.ai_file.stat().st_size <= MMAP_THRESHOLD:
+                    return json_util.loads(f.read())
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    return json_util.loads(view)
         except Exception as e:
             logger.error(f"加载 AI 配置失败: {e}")
             return {}
 
-    def save(self) -> bool:
-        """保存所有AI配置"""
-        try:
-            with open(self.ai_file, "w", encoding="utf-8") as f:
-                json.dump(self.ais, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"保存 AI 配置失败: {e}")
-            return False
+    def save(self, force: bool = False) -> bool:
+        """
+        保存所有AI配置
+
+        默认只标记为待保存，SAVE_DELAY秒内没有新的修改才真正写盘；
+        force=True时立即写盘并返回写入结果
+        """
+        with self._lock:
+            self._dirty = True
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            if not force:
+                self._flush_timer = threading.Timer(SAVE_DELAY, self._flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+                return True
+
+        return self._flush()
+
+    def _flush(self) -> bool:
+        """把未保存的修改写入ai.json"""
+        with self._lock:
+            if not self._dirty:
+                return True
+
+            try:
+                write_atomic(self.ai_file, json_util.dumps(self.ais, indent=True))
+                self._dirty = False
+                return True
+            except Exception as e:
+                logger.error(f"保存 AI 配置失败: {e}")
+                return False
 
     def get(self, uuid: str) -> dict | None:
         """获取AI配置"""
         return self.ais.get(uuid)
 
     def set(self, uuid: str, config: dict) -> bool:
-        self.ais[uuid] = config
+        with self._lock:
+            self.ais[uuid] = config
+            self.version += 1
+            self._targets.clear()
         return self.save()
 
-    def list(self) -> dict:
-        """列出所有AI配置（返回副本）"""
-        return self.ais.copy()
+    def list(self) -> MappingProxyType:
+        """列出所有AI配置（返回只读视图，不复制）"""
+        return self._ais_view
 
     def delete(self, uuid: str) -> bool:
         """删除指定UUID的AI配置"""
@@ -54,39 +116,104 @@ class AIConfigManager:
             logger.warning(f"尝试删除不存在的UUID: {uuid}")
             return False
 
-        del self.ais[uuid]
+        with self._lock:
+            self.ais.pop(uuid, None)
+            self.version += 1
+            self._targets.clear()
         return self.save()
 
-    def call_ai(self, ai_config: Dict, payload: Dict) -> Optional[Dict]:
-        """调用AI服务"""
-        try:
-            provider = ai_config.get("provider", "openai")
-            base_url = ai_config.get("base_url", "https://api.openai.com/v1")
-            api_key = ai_config.get("api_key", "")
-
-            # 设置endpoint
-            if provider == "ollama":
-                endpoint = "/api/chat"
-                if "localhost" not in base_url:
-                    base_url = "http://localhost:11434"
-            else:
-                endpoint = "/chat/completions"
+    def _request_target(self, ai_config: Dict) -> tuple:
+        """根据AI配置得到请求地址和请求头（每份配置只算一次）"""
+        # 缓存里保存着配置本身，只要还在缓存里它的id就不会被别的对象复用
+        cached = self._targets.get(id(ai_config))
+        if cached is not None and cached[0] is ai_config:
+            return cached[1], cached[2]
+
+        provider = ai_config.get("provider", "openai")
+        base_url = ai_config.get("base_url", "https://api.openai.com/v1")
+        api_key = ai_config.get("api_key", "")
+
+        # 设置endpoint
+        if provider == "ollama":
+            endpoint = "/api/chat"
+            if "localhost" not in base_url:
+                base_url = "http://localhost:11434"
+        else:
+            endpoint = "/chat/completions"
 
-            url = f"{base_url.rstrip('/')}{endpoint}"
+        url = f"{base_url.rstrip('/')}{endpoint}"
 
-            headers = {"Content-Type": "application/json"}
-            if provider != "ollama":
-                headers["Authorization"] = f"Bearer {api_key}"
+        headers = {"Content-Type": "application/json"}
+        if provider != "ollama":
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        self._targets[id(ai_config)] = (ai_config, url, headers)
+        return url, headers
+
+    def _session_for(self, ai_config: Dict) -> "requests.Session":
+        """获取连接池大小对应的Session（第一次用到时创建，requests也是这时才导入）"""
+        pool_maxsize = int(ai_config.get("pool_maxsize", POOL_MAXSIZE))
+        session = self._sessions.get(pool_maxsize)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(pool_maxsize)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                # 连不上、限流(429)、上游没接住请求(502/503)时稍等重试
+                # 读超时和504时上游可能已经在生成了，再发一次会等好几倍的时间还要重复计费，所以不重试
+                retry = Retry(
+                    total=2,
+                    read=0,
+                    backoff_factor=0.2,
+                    status_forcelist=[429, 502, 503],
+                    allowed_methods=frozenset({"POST"}),
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_maxsize, max_retries=retry)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[pool_maxsize] = session
+            return session
+
+    def call_ai(self, ai_config: Dict, payload: Dict, cache: bool = False) -> Optional[Dict]:
+        """
+        调用AI服务
+
+        :param cache: 总是使用回复缓存(压缩这类同样的输入用同一个结果就行的请求)
+        """
+        try:
+            url, headers = self._request_target(ai_config)
 
             # 设置超时
             timeout = ai_config.get("timeout", 30)
 
-            logger.debug(f"发送请求到: {url}")
+            logger.debug("发送请求到: %s", url)
 
-            response = requests.post(url, headers=headers, json=payload, timeout=timeout)
+            # temperature为0时回复是确定的，完全相同的请求直接用上次的回复
+            cache_key = None
+            if cache or payload.get("temperature", 1) <= 0 or ai_config.get("cache_nondeterministic"):
+                body = json_util.dumps_payload(payload, sort_keys=True)
+                cache_key = llm_cache.make_key(url, body)
+                cached = llm_cache.get(cache_key)
+                if cached is not None:
+                    logger.debug("命中AI回复缓存: %s", url)
+                    return cached
+            else:
+                body = json_util.dumps_payload(payload)
+
+            response = self._session_for(ai_config).post(url, headers=headers, data=body, timeout=timeout)
 
             if response.status_code == 200:
-                return response.json()
+                result = json_util.loads(response.content)
+                if cache_key is not None:
+                    llm_cache.put(cache_key, result)
+                return result
             else:
                 logger.error(f"AI请求失败 {response.status_code}: {response.text[:200]}")
                 return None
@@ -95,4 +222,51 @@ class AIConfigManager:
             logger.error(f"调用AI失败: {e}")
             return None
 
-ai_manager = AIConfigManager()
\ No newline at end of file
+    def stream_ai(self, ai_config: Dict, payload: Dict) -> Iterator[Dict]:
+        """
+        流式调用AI服务，逐个产出上游返回的数据块
+
+        兼容SSE(`data: {...}`)和逐行JSON两种格式，出错时直接抛出异常
+        """
+        url, headers = self._request_target(ai_config)
+        timeout = ai_config.get("timeout", 30)
+
+        logger.debug("发送流式请求到: %s", url)
+
+        session = self._session_for(ai_config)
+        body = json_util.dumps_payload(payload)
+        with session.post(url, headers=headers, data=body, timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"AI请求失败 {response.status_code}: {response.text[:200]}")
+
+            for line in response.iter_lines():
+                # 跳过空行和SSE注释(心跳)
+                if not line or line.startswith(b":"):
+                    continue
+                if line.startswith(b"data:"):
+                    line = line[5:].strip()
+                if line == b"[DONE]":
+                    break
+                yield json_util.loads(line)
+
+
+_ai_manager: Optional[AIConfigManager] = None
+_ai_manager_lock = threading.Lock()
+
+
+def get_ai_manager() -> AIConfigManager:
+    """获取全局AI配置管理器（首次调用时才加载ai.json）"""
+    global _ai_manager
+    if _ai_manager is None:
+        # 多线程同时第一次调用时只能创建一个实例，否则各自的写盘定时器会互相覆盖ai.json
+        with _ai_manager_lock:
+            if _ai_manager is None:
+                _ai_manager = AIConfigManager()
+    return _ai_manager
+
+
+def __getattr__(name: str):
+    # 兼容旧的 `from managers.ai_manager import ai_manager`
+    if name == "ai_manager":
+        return get_ai_manager()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
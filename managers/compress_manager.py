@@ -1,17 +1,127 @@
 """
 压缩管理器 - 负责对话历史的智能压缩
 """
-import json
+import hashlib
+import io
 from pathlib import Path
 from typing import Dict, List, Any, Optional
 
+from utils import json_util
 from utils.ai_response_util import extract_ai_response
 from utils.logger import logger
-from managers.ai_manager import ai_manager
+from managers.ai_manager import get_ai_manager
 from managers.conversation_manager import conversation_manager
 from utils.payload_util import generate_payload
 
 
+# 压缩时提供给AI的工具，内容固定，只序列化一次
+COMPRESSION_TOOLS = json_util.RawJSON.of([
+    {
+        "type": "function",
+        "function": {
+            "name": "no_compress",
+            "description": "当对话未完成，不适合压缩时调用",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "reason": {
+                        "type": "string",
+                        "description": "不适合压缩的原因"
+                    }
+                },
+                "required": ["reason"]
+            }
+        }
+    }
+])
+
+
+def _fmt_user(content: str, tool_call_id: str, tool_calls: tuple) -> str:
+    return f"[用户] {content}\n"
+
+
+def _fmt_assistant(content: str, tool_call_id: str, tool_calls: tuple) -> str:
+    if not tool_calls:
+        return f"[助手] {content}\n"
+
+    calls = []
+    for name, args in tool_calls:
+        try:
+            # 尝试解析JSON参数
+            args_dict = json_util.loads(args)
+            args_str = ", ".join([f"{k}={v}" for k, v in args_dict.items()])
+        except:
+            args_str = args
+        calls.append(f"调用工具: {name}({args_str})")
+
+    return f"[助手] {content if content else '调用工具'}\n  -> {'；'.join(calls)}\n"
+
+
+def _fmt_tool(content: str, tool_call_id: str, tool_calls: tuple) -> str:
+    tag = tool_call_id[:8]
+
+    # 以{开头的内容直接尝试按JSON解析并简化，只看首字符
+    if content[:1] == "{":
+        try:
+            data = json_util.loads(content)
+            # 简化显示：只显示键名和类型
+            simplified = {k: type(v).__name__ for k, v in data.items()}
+            return f"[工具响应 {tag}] 返回数据: {simplified}\n"
+        except Exception:
+            pass
+
+    # 非JSON内容（或解析失败），适当截断
+    if len(content) > 100:
+        return f"[工具响应 {tag}] 返回内容: {content[:100]}...\n"
+    return f"[工具响应 {tag}] 返回内容: {content}\n"
+
+
+# 角色 -> 格式化函数，不在表里的角色（比如system）不参与压缩
+_ROLE_HANDLERS = {
+    "user": _fmt_user,
+    "assistant": _fmt_assistant,
+    "tool": _fmt_tool,
+}
+
+
+# 最多缓存多少条消息的格式化结果
+FORMAT_CACHE_SIZE = 2048
+# 只缓存这个长度以内的结果（长的用户/助手消息原文会出现在结果里，缓存了等于一直留着原文）
+FORMAT_CACHE_MAX_LEN = 1024
+
+# (role, 消息内容的摘要) -> 格式化结果，key里只有摘要，长的工具返回不会一直留在内存里
+_format_cache: Dict[tuple, str] = {}
+
+
+def _format_message(role: str, content: str, tool_call_id: str, tool_calls: tuple) -> str:
+    """
+    格式化单条消息，结果以换行结尾
+
+    消息写入后不会再变，需要解析JSON的消息之后每次压缩都直接命中缓存
+
+    Args:
+        tool_calls: ((工具名, 参数JSON), ...)
+    """
+    handler = _ROLE_HANDLERS[role]
+    # 只有要解析JSON的消息(工具调用参数、JSON格式的工具返回)才值得缓存
+    # 普通文本一次f-string就拼好了，算缓存key反而比直接格式化慢
+    if not (tool_calls or (role == "tool" and content[:1] == "{")):
+        return handler(content, tool_call_id, tool_calls)
+
+    key = (role, hashlib.blake2b(json_util.dumps([content, tool_call_id, tool_calls]), digest_size=16).digest())
+    result = _format_cache.get(key)
+    if result is not None:
+        return result
+
+    result = handler(content, tool_call_id, tool_calls)
+    if len(result) <= FORMAT_CACHE_MAX_LEN:
+        if len(_format_cache) >= FORMAT_CACHE_SIZE:
+            # 满了就丢掉最早放进来的
+            del _format_cache[next(iter(_format_cache))]
+        _format_cache[key] = result
+    return result
+
+
 class CompressManager:
     """压缩管理器 - 负责对话历史的智能压缩"""
 
@@ -38,12 +148,11 @@ class CompressManager:
                 return False
 
             # 2. 获取对话元数据
-            conv_data = conversation_manager.get_conversation_context(conversation_id)
-            if not conv_data:
+            metadata = conversation_manager.get_metadata(conversation_id)
+            if not metadata:
                 logger.error(f"无法获取对话 {conversation_id} 的数据")
                 return False
 
-            metadata = conv_data.get("metadata", {})
             ai_uuid = metadata.get("ai")
             prompt_type = metadata.get("prompt", "common")
 
@@ -52,7 +161,7 @@ class CompressManager:
                 return False
 
             # 3. 获取AI配置
-            ai_config = ai_manager.get(ai_uuid)
+            ai_config = get_ai_manager().get(ai_uuid)
             if not ai_config:
                 logger.error(f"AI配置 {ai_uuid} 不存在")
                 return False
@@ -79,27 +188,6 @@ class CompressManager:
             # 构建用户消息
             user_message = f"请分析以上对话历史，判断是否适合压缩并生成压缩总结。\n\n对话历史（共{len(messages_to_compress)}条消息）：\n{formatted_history}"
 
-            # 6. 准备工具（只提供no_compress工具）
-            compression_tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "no_compress",
-                        "description": "当对话未完成，不适合压缩时调用",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "reason": {
-                                    "type": "string",
-                                    "description": "不适合压缩的原因"
-                                }
-                            },
-                            "required": ["reason"]
-                        }
-                    }
-                }
-            ]
-
             # 7. 调用AI进行压缩判断
             logger.info(f"调用AI进行压缩判断，provider: {ai_config['provider']}, model: {ai_config['model']}")
 
@@ -110,9 +198,9 @@ class CompressManager:
                 messages=[user_message],
                 role="user",
                 context=[],  # 不需要额外上下文，因为历史已经在user_message中
-                ai=ai_uuid,  # 使用相同的AI配置
+                ai_config=ai_config,  # 使用相同的AI配置
                 device=f"压缩任务-{conversation_id}",  # 包含"压缩任务"，触发压缩逻辑
-                tools=compression_tools
+                tools=COMPRESSION_TOOLS  # 只提供no_compress工具
             )
 
             if not payload:
@@ -122,7 +210,8 @@ class CompressManager:
 
             # 8. 发送请求
             provider = ai_config.get("provider", "openai")
-            response = ai_manager.call_ai(ai_config, payload)
+            # 同一段历史重复压缩(比如上次更新失败)时直接复用上次的判断结果
+            response = get_ai_manager().call_ai(ai_config, payload, cache=True)
 
             if not response:
                 logger.error("AI压缩调用失败")
@@ -130,17 +219,20 @@ class CompressManager:
 
             # 9. 处理响应
             extracted = extract_ai_response(response, provider)
+            if extracted is None:
+                logger.error(f"不支持的provider: {provider}")
+                return False
 
             # 检查是否有工具调用
-            if extracted.get("tools") and len(extracted["tools"]) > 0:
-                tool_call = extracted["tools"][0]
+            if extracted.tools:
+                tool_call = extracted.tools[0]
                 if tool_call["function"]["name"] == "no_compress":
                     reason = tool_call["function"]["arguments"]
                     logger.info(f"AI判断不适合压缩: {reason}")
                     return False
 
             # 10. 获取压缩总结
-            compressed_summary = extracted.get("message", "").strip()
+            compressed_summary = extracted.message.strip()
             if not compressed_summary:
                 logger.warning("AI返回的压缩总结为空")
                 return False
@@ -149,7 +241,8 @@ class CompressManager:
             success = conversation_manager.update_after_compression(
                 conversation_id=conversation_id,
                 compressed_summary=compressed_summary,
-                keep_recent_messages=keep_recent
+                keep_recent_messages=keep_recent,
+                compressed_count=len(messages_to_compress)
             )
 
             if success:
@@ -166,64 +259,23 @@ class CompressManager:
             return False
 
     def _format_messages_for_compression(self, messages: List[Dict]) -> str:
-        """格式化消息用于压缩处理"""
-        formatted = []
+        """格式化消息用于压缩处理（每条消息的结果会被缓存）"""
+        buf = io.StringIO()
+        write = buf.write
 
-        for i, msg in enumerate(messages):
+        for msg in messages:
             role = msg.get("role", "unknown")
-            content = msg.get("content", "")
-
-            # 处理不同角色
-            if role == "user":
-                formatted.append(f"[用户] {content}")
-            elif role == "assistant":
-                # 检查是否有工具调用
-                tool_calls = msg.get("tool_calls")
-                if tool_calls:
-                    tools_summary = []
-                    for tool in tool_calls:
-                        func = tool.get("function", {})
-                        name = func.get("name", "")
-                        args = func.get("arguments", "")
-                        try:
-                            # 尝试解析JSON参数
-                            import json as json_lib
-                            args_dict = json_lib.loads(args)
-                            args_str = ", ".join([f"{k}={v}" for k, v in args_dict.items()])
-                        except:
-                            args_str = args
-                        tools_summary.append(f"调用工具: {name}({args_str})")
-
-                    tool_text = "；".join(tools_summary)
-                    formatted.append(f"[助手] {content if content else '调用工具'}")
-                    if tool_text:
-                        formatted.append(f"  -> {tool_text}")
-                else:
-                    formatted.append(f"[助手] {content}")
-            elif role == "tool":
-                # 对tool返回的内容进行适当处理
-                tool_call_id = msg.get("tool_call_id", "unknown")
-
-                # 如果是JSON内容，尝试解析并简化
-                if content.startswith("{") and content.endswith("}"):
-                    try:
-                        import json as json_lib
-                        data = json_lib.loads(content)
-                        # 简化显示：只显示键名和类型
-                        simplified = {k: type(v).__name__ for k, v in data.items()}
-                        content_summary = f"返回数据: {simplified}"
-                    except:
-                        content_summary = "返回数据（格式复杂）"
-                else:
-                    # 非JSON内容，适当截断
-                    if len(content) > 100:
-                        content_summary = f"返回内容: {content[:100]}..."
-                    else:
-                        content_summary = f"返回内容: {content}"
-
-                formatted.append(f"[工具响应 {tool_call_id[:8]}] {content_summary}")
-
-        return "\n".join(formatted)
+            if role not in _ROLE_HANDLERS:
+                continue
+
+            tool_calls = tuple(
+                (tool.get("function", {}).get("name", ""), tool.get("function", {}).get("arguments", ""))
+                for tool in msg.get("tool_calls") or ()
+            )
+            write(_format_message(role, msg.get("content", ""), msg.get("tool_call_id", "unknown"), tool_calls))
+
+        # 去掉最后一行的换行
+        return buf.getvalue()[:-1]
 
 
 # 全局实例
@@ -1,22 +1,84 @@
-import json
+import atexit
+import os
+import threading
 import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 from uuid import uuid4
 
+from utils import json_util
+from utils.file_utils import ensure_dir, write_atomic
 from utils.logger import logger
 
+# 每个对话目录下的历史文件（JSON Lines，一行一条）
+HISTORY_FILES = ("tactical", "archive", "raw_context")
+
+# 元数据两次写盘的最小间隔（秒），期间的修改合并为一次写入
+METADATA_FLUSH_INTERVAL = 1.0
+
+# 每多少条消息尝试压缩一次（和以前interval从10减到0再触发的节奏一致）
+COMPRESS_EVERY = 11
+
+# 两次尝试压缩的最小间隔（秒）
+COMPRESS_COOLDOWN = 60
+
+# 读历史文件用的线程池，几个互不相关的文件同时读
+_io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history-io")
+
+# 压缩要再调用一次AI，放到后台线程里排队做，不拖慢触发它的那一轮对话
+_compress_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compress")
+
+# 消息追加写盘的合并窗口（秒），窗口内的多次追加合并成每个文件一次写入
+WRITE_BATCH_DELAY = 0.05
+
+# 后台写入失败后隔多久重试
+WRITE_RETRY_DELAY = 1.0
+
+# 从文件末尾往前读时每次读取的字节数
+TAIL_CHUNK_SIZE = 8 * 1024
+
 
 class ConversationManager:
     """对话管理器 - 负责对话数据的存储和检索"""
 
     def __init__(self, base_dir: str = "data/history"):
         self.base_dir = Path(base_dir)
-        self.base_dir.mkdir(parents=True, exist_ok=True)
+        ensure_dir(str(self.base_dir))
 
         # 元数据文件
         self.meta_file = self.base_dir / "data.json"
         self.conversations = self._load_metadata()
+        self._migrate_json_files()
+
+        # 设备ID -> {对话ID: 元数据}，按设备列出对话时不用扫描全部对话
+        self._by_device: Dict[str, Dict[str, Dict]] = defaultdict(dict)
+        for conversation_id, meta in self.conversations.items():
+            self._by_device[meta.get("device")][conversation_id] = meta
+
+        # 各对话tactical的内存副本（第一次用到时从文件加载），省掉压缩前和组上下文时的重复读取
+        self._tactical_cache: Dict[str, List[Dict]] = {}
+        # 各对话上下文的版本号，压缩改写了tactical/archive时+1（平时上下文只会在末尾追加）
+        self._context_versions: Dict[str, int] = {}
+        # 追加tactical和压缩后改写tactical互斥，避免改写时丢掉刚追加的消息
+        self._history_lock = threading.RLock()
+
+        # 对话ID -> {文件: 还没写盘的追加数据}，由后台定时器合并写入；读某个对话的文件前只写完这个对话的
+        self._pending_writes: Dict[str, Dict[Path, List[bytes]]] = {}
+        # 后台写入失败的对话，数据放回了队列，下次给这个对话添加消息时重试并把失败报告给调用方
+        self._write_failed: set = set()
+        self._write_lock = threading.Lock()
+        # 真正写盘时持有，保证同一文件的追加按顺序进行；写盘期间不占_write_lock，添加消息不用等磁盘
+        self._flush_lock = threading.Lock()
+        self._write_timer: Optional[threading.Timer] = None
+
+        self._dirty = False
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        atexit.register(self._maybe_flush, force=True)
+        atexit.register(self.flush)
 
     def _load_metadata(self) -> Dict:
         """加载对话元数据"""
@@ -24,22 +86,88 @@ class ConversationManager:
             return {}
 
         try:
-            with open(self.meta_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(self.meta_file, 'rb') as f:
+                return json_util.loads(f.read())
         except Exception as e:
             logger.error(f"加载对话元数据失败: {e}")
             return {}
 
+    def _migrate_json_files(self):
+        """把旧版整文件JSON格式的历史转换为JSONL（每个文件只转换一次）"""
+        for conversation_id in self.conversations:
+            conv_dir = self.base_dir / conversation_id
+            for name in HISTORY_FILES:
+                old_file = conv_dir / f"{name}.json"
+                if not old_file.exists():
+                    continue
+
+                try:
+                    with open(old_file, 'rb') as f:
+                        items = json_util.loads(f.read())
+                    self._write_jsonl(conv_dir / f"{name}.jsonl", items)
+                    old_file.unlink()
+                    logger.info(f"已将 {old_file} 转换为JSONL")
+                except Exception as e:
+                    logger.error(f"转换历史文件失败 {old_file}: {e}")
+
     def _save_metadata(self) -> bool:
-        """保存对话元数据"""
+        """保存对话元数据（调用方需持有self._lock）"""
         try:
-            with open(self.meta_file, 'w', encoding='utf-8') as f:
-                json.dump(self.conversations, f, ensure_ascii=False, indent=2)
+            write_atomic(self.meta_file, json_util.dumps(self.conversations))
+            self._dirty = False
+            self._last_flush = time.monotonic()
             return True
         except Exception as e:
             logger.error(f"保存对话元数据失败: {e}")
             return False
 
+    def _get_tactical(self, conversation_id: str) -> List[Dict]:
+        """获取tactical的内存副本，不在缓存里时从文件加载一次"""
+        tactical = self._tactical_cache.get(conversation_id)
+        if tactical is not None:
+            return tactical
+
+        with self._history_lock:
+            tactical = self._tactical_cache.get(conversation_id)
+            if tactical is None:
+                self.flush(conversation_id)
+                tactical = self._read_jsonl(self.base_dir / conversation_id / "tactical.jsonl")
+                self._tactical_cache[conversation_id] = tactical
+            return tactical
+
+    def get_context_version(self, conversation_id: str) -> int:
+        """获取对话上下文的版本号，版本号不变时get_context_for_ai的结果只会在末尾追加"""
+        return self._context_versions.get(conversation_id, 0)
+
+    def _mark_dirty(self):
+        """标记元数据有未保存的修改"""
+        self._dirty = True
+
+    def _maybe_flush(self, force: bool = False) -> bool:
+        """
+        把未保存的元数据写入data.json
+
+        距上次写盘不足METADATA_FLUSH_INTERVAL秒时只安排一次延迟写入；
+        force=True时立即写入并返回写入结果
+        """
+        with self._lock:
+            if not self._dirty:
+                return True
+
+            wait = METADATA_FLUSH_INTERVAL - (time.monotonic() - self._last_flush)
+            if not force and wait > 0:
+                if self._flush_timer is None:
+                    self._flush_timer = threading.Timer(wait, self._maybe_flush, kwargs={"force": True})
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+                return True
+
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            return self._save_metadata()
+
     def create_conversation(
             self,
             name: str,
@@ -64,26 +192,27 @@ class ConversationManager:
         conv_dir.mkdir(parents=True, exist_ok=True)
 
         # 初始化三个空文件
-        initial_data = []
-        for filename in ["tactical.json", "archive.json", "raw_context.json"]:
-            filepath = conv_dir / filename
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(initial_data, f, ensure_ascii=False, indent=2)
+        for history_name in HISTORY_FILES:
+            (conv_dir / f"{history_name}.jsonl").touch()
 
         # 保存元数据
-        self.conversations[conversation_id] = {
+        now = int(time.time())
+        metadata = {
             "name": name,
             "prompt": prompt_type,
             "ai": ai_uuid,
-            "interval": 10,  # 默认10条消息后尝试压缩
             "device": device_id,
-            "created": int(time.time()),
-            "updated": int(time.time()),
+            "created": now,
+            "updated": now,
             "message_count": 0,
             "last_compress_attempt": 0  # 上次尝试压缩的时间戳
         }
 
-        self._save_metadata()
+        with self._lock:
+            self.conversations[conversation_id] = metadata
+            self._by_device[device_id][conversation_id] = metadata
+        self._mark_dirty()
+        self._maybe_flush(force=True)
         logger.info(f"创建新对话: {name} (ID: {conversation_id})")
 
         return conversation_id
@@ -113,7 +242,31 @@ class ConversationManager:
         Returns:
             是否成功
         """
-        if conversation_id not in self.conversations:
+        return self.add_messages(conversation_id, [{
+            "role": role,
+            "content": content,
+            "tool_calls": tool_calls,
+            "finish_reason": finish_reason,
+            "total_tokens": total_tokens,
+            "tool_call_id": tool_call_id
+        }])
+
+    def add_messages(self, conversation_id: str, messages: List[Dict]) -> bool:
+        """
+        一次添加多条消息到对话
+
+        所有消息一起写入文件，元数据更新、压缩检查和保存都只做一次
+
+        Args:
+            conversation_id: 对话ID
+            messages: 消息列表，每条的字段和add_message的参数相同
+                      (role, content, tool_calls, finish_reason, total_tokens, tool_call_id)
+
+        Returns:
+            是否成功
+        """
+        meta = self.conversations.get(conversation_id)
+        if meta is None:
             logger.error(f"对话不存在: {conversation_id}")
             return False
 
@@ -122,11 +275,87 @@ class ConversationManager:
             logger.error(f"对话目录不存在: {conv_dir}")
             return False
 
-        # 创建消息对象
+        now = int(time.time())
+        built = [self._build_message(now, **item) for item in messages]
+        if not built:
+            return True
+
+        # 之前后台写入这个对话失败过：先重试，还是失败就不再接收新消息
+        if conversation_id in self._write_failed and not self.flush(conversation_id):
+            logger.error(f"对话 {conversation_id} 的历史记录写入失败，拒绝添加消息")
+            return False
+
+        try:
+            # 所有消息只序列化一次，两个文件写同一份数据
+            blob = b''.join(json_util.dumps(message) + b'\n' for message in built)
+
+            # 1. 添加到raw_context（完整历史记录），文件由后台合并写入
+            self._queue_append(conversation_id, conv_dir / "raw_context.jsonl", blob)
+
+            # 2. 添加到tactical（当前上下文），内存副本立即更新
+            with self._history_lock:
+                self._queue_append(conversation_id, conv_dir / "tactical.jsonl", blob)
+                if conversation_id in self._tactical_cache:
+                    self._tactical_cache[conversation_id].extend(built)
+
+            # 3. 更新元数据：消息计数和更新时间
+            before = meta["message_count"]
+            meta["message_count"] = before + len(built)
+            meta["updated"] = now
+
+            # 4. 检查是否需要尝试压缩：每COMPRESS_EVERY条消息一次，且距上次尝试超过冷却时间
+            compress_every = meta.get("compress_every", COMPRESS_EVERY)
+            if (meta["message_count"] // compress_every != before // compress_every
+                    and now - meta.get("last_compress_attempt", 0) > COMPRESS_COOLDOWN):
+                logger.info("对话 %s 已有%s条消息，触发压缩检查", conversation_id, meta['message_count'])
+
+                # 不管成功与否都记录尝试时间，避免频繁尝试
+                meta["last_compress_attempt"] = now
+                _compress_pool.submit(self._compress, conversation_id)
+
+            # 5. 保存元数据（合并短时间内的多次修改）
+            self._mark_dirty()
+            self._maybe_flush()
+
+            logger.debug("对话 %s 添加%s条消息，当前消息数: %s", conversation_id, len(built), meta['message_count'])
+            return True
+
+        except Exception as e:
+            logger.error(f"添加消息失败: {e}")
+            return False
+
+    def _compress(self, conversation_id: str):
+        """尝试压缩一个对话（在_compress_pool的后台线程里运行）"""
+        try:
+            from managers.compress_manager import compress_manager
+        except ImportError:
+            # CompressManager还没实现，暂时跳过
+            logger.warning(f"CompressManager未实现，跳过压缩检查")
+            return
+
+        try:
+            if compress_manager.compress(conversation_id, self.get_tactical_content(conversation_id)):
+                logger.info(f"对话 {conversation_id} 压缩成功")
+            else:
+                logger.info(f"对话 {conversation_id} 压缩失败或被拒绝")
+        except Exception as e:
+            logger.error(f"后台压缩失败: {e}")
+
+    @staticmethod
+    def _build_message(
+            now: int,
+            role: str,
+            content: str,
+            tool_calls: Optional[List] = None,
+            finish_reason: Optional[str] = None,
+            total_tokens: int = 0,
+            tool_call_id: Optional[str] = None
+    ) -> Dict:
+        """创建要保存的消息对象"""
         message = {
             "role": role,
             "content": content,
-            "timestamp": int(time.time())
+            "timestamp": now
         }
 
         # 添加可选字段
@@ -144,81 +373,156 @@ class ConversationManager:
             # 或者生成一个默认的
             logger.warning(f"Tool消息缺少tool_call_id: {content[:100]}")
             # 这里可以尝试从content中提取，或者使用一个占位符
-            message["tool_call_id"] = f"call_{int(time.time())}"
-
-        try:
-            # 1. 添加到raw_context（完整历史记录）
-            self._append_to_file(conv_dir / "raw_context.json", message)
-
-            # 2. 添加到tactical（当前上下文）
-            self._append_to_file(conv_dir / "tactical.json", message)
+            message["tool_call_id"] = f"call_{now}"
 
-            # 3. 更新元数据：消息计数和更新时间
-            self.conversations[conversation_id]["message_count"] += 1
-            self.conversations[conversation_id]["updated"] = int(time.time())
+        return message
 
-            # 4. 检查是否需要尝试压缩
-            metadata = self.conversations[conversation_id]
+    def _append_to_file(self, filepath: Path, data: Dict):
+        """向JSONL文件追加一条数据（只写新的一行，不重写整个文件）"""
+        self._append_bytes(filepath, json_util.dumps(data) + b'\n')
+
+    def _queue_append(self, conversation_id: str, filepath: Path, blob: bytes):
+        """把要追加的数据放进写入队列，WRITE_BATCH_DELAY秒后统一写盘"""
+        with self._write_lock:
+            self._pending_writes.setdefault(conversation_id, {}).setdefault(filepath, []).append(blob)
+            self._arm_write_timer(WRITE_BATCH_DELAY)
+
+    def _arm_write_timer(self, delay: float):
+        """启动后台写盘定时器（已经有一个在等待时不重复启动，调用方需持有self._write_lock）"""
+        if self._write_timer is None:
+            self._write_timer = threading.Timer(delay, self.flush)
+            self._write_timer.daemon = True
+            self._write_timer.start()
+
+    def flush(self, conversation_id: Optional[str] = None) -> bool:
+        """
+        把队列里还没写盘的消息立即写入文件
 
-            # interval减1（但不能小于0）
-            current_interval = metadata.get("interval", 10)
-            if current_interval > 0:
-                self.conversations[conversation_id]["interval"] = current_interval - 1
-                logger.debug(f"对话 {conversation_id} interval减至: {current_interval - 1}")
-            else:
-                # interval为0时，尝试压缩
-                logger.info(f"对话 {conversation_id} interval为0，触发压缩检查")
+        Args:
+            conversation_id: 只写这个对话的；不传时写全部（后台定时器和退出时）
 
-                # 获取tactical内容用于压缩
-                tactical_file = conv_dir / "tactical.json"
-                with open(tactical_file, 'r', encoding='utf-8') as f:
-                    tactical_content = json.load(f)
+        Returns:
+            是否全部写入成功（失败的数据会放回队列，WRITE_RETRY_DELAY秒后再写）
+        """
+        with self._flush_lock:
+            # 只在取出待写数据时持有_write_lock，写盘时别的线程照常往队列里追加
+            with self._write_lock:
+                if conversation_id is None:
+                    if self._write_timer is not None:
+                        self._write_timer.cancel()
+                        self._write_timer = None
+                    pending = self._pending_writes
+                    self._pending_writes = {}
+                else:
+                    files = self._pending_writes.pop(conversation_id, None)
+                    pending = {conversation_id: files} if files else {}
+
+            ok = True
+            failed_writes = {}
+            succeeded = []
+            for cid, files in pending.items():
+                if cid not in self.conversations:
+                    # 对话已经被删除
+                    succeeded.append(cid)
+                    continue
+
+                failed = {}
+                for filepath, blobs in files.items():
+                    try:
+                        self._append_bytes(filepath, b''.join(blobs))
+                    except Exception as e:
+                        logger.error(f"写入历史记录失败 {filepath}: {e}")
+                        failed[filepath] = blobs
+
+                if failed:
+                    ok = False
+                    failed_writes[cid] = failed
+                else:
+                    succeeded.append(cid)
+
+            if not pending:
+                return ok
+
+            with self._write_lock:
+                for cid in succeeded:
+                    self._write_failed.discard(cid)
+
+                for cid, failed in failed_writes.items():
+                    self._write_failed.add(cid)
+                    # 放回队列的最前面，排在写盘期间新追加的数据前面
+                    queued = self._pending_writes.setdefault(cid, {})
+                    for filepath, blobs in failed.items():
+                        queued[filepath] = blobs + queued.get(filepath, [])
+
+                if failed_writes:
+                    self._arm_write_timer(WRITE_RETRY_DELAY)
+            return ok
+
+    def _discard_pending(self, conversation_id: str):
+        """丢掉一个对话还没写盘的数据（对话被删除时，会等正在进行的写盘结束）"""
+        with self._flush_lock, self._write_lock:
+            self._pending_writes.pop(conversation_id, None)
+            self._write_failed.discard(conversation_id)
+
+    def _append_bytes(self, filepath: Path, blob: bytes):
+        """向JSONL文件追加已经序列化好的若干行"""
+        with open(filepath, 'a+b') as f:
+            # 上次写到一半崩溃时最后一行没有换行，先补一个，不然新记录会粘在半行后面一起被读取时丢掉
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    blob = b'\n' + blob
+            f.write(blob)
+
+    def _read_jsonl(self, filepath: Path) -> List[Dict]:
+        """读取JSONL文件，跳过无法解析的行（比如写到一半崩溃留下的半行）"""
+        if not filepath.exists():
+            return []
 
-                # 这里调用CompressManager.compress()，先假设存在
+        items = []
+        with open(filepath, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
                 try:
+                    items.append(json_util.loads(line))
+                except ValueError:
+                    logger.warning(f"跳过无法解析的历史记录: {filepath}")
+        return items
+
+    def _tail_jsonl(self, filepath: Path, n: int) -> List[Dict]:
+        """读取JSONL文件的最后n条（从文件末尾往前按块读，耗时和文件总长度无关）"""
+        if n <= 0 or not filepath.exists():
+            return []
 
-                    from managers.compress_manager import compress_manager
-                    compress_success = compress_manager.compress(conversation_id, tactical_content)
-
-                    if compress_success:
-                        # 压缩成功，重置interval为10
-                        self.conversations[conversation_id]["interval"] = 10
-                        self.conversations[conversation_id]["last_compress_attempt"] = int(time.time())
-                        logger.info(f"对话 {conversation_id} 压缩成功，interval重置为10")
-                    else:
-                        # 压缩失败或被拒绝，将interval设为10，避免频繁尝试
-                        self.conversations[conversation_id]["interval"] = 10
-                        self.conversations[conversation_id]["last_compress_attempt"] = int(time.time())
-                        logger.info(f"对话 {conversation_id} 压缩失败或被拒绝，interval重置为10")
-
-                except ImportError:
-                    # CompressManager还没实现，暂时跳过
-                    logger.warning(f"CompressManager未实现，跳过压缩检查")
-                    # 即使没有CompressManager，也重置interval避免无限循环
-                    self.conversations[conversation_id]["interval"] = 10
-
-            # 5. 保存元数据
-            self._save_metadata()
-
-            logger.debug(
-                f"对话 {conversation_id} 添加{role}消息，当前interval: {self.conversations[conversation_id]['interval']}")
-            return True
-
-        except Exception as e:
-            logger.error(f"添加消息失败: {e}")
-            return False
-
-    def _append_to_file(self, filepath: Path, data: Dict):
-        """向JSON文件追加数据"""
-        existing_data = []
-        if filepath.exists():
-            with open(filepath, 'r', encoding='utf-8') as f:
-                existing_data = json.load(f)
-
-        existing_data.append(data)
+        with open(filepath, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            data = b''
+            # 多读到n+1个换行，保证最后n行都是完整的
+            while pos > 0 and data.count(b'\n') <= n:
+                step = min(TAIL_CHUNK_SIZE, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+
+        lines = data.split(b'\n')
+        if pos > 0:
+            # 没读到文件开头，第一段可能是半行
+            lines = lines[1:]
+
+        items = deque(maxlen=n)
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                items.append(json_util.loads(line))
+            except ValueError:
+                logger.warning(f"跳过无法解析的历史记录: {filepath}")
+        return list(items)
 
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(existing_data, f, ensure_ascii=False, indent=2)
+    def _write_jsonl(self, filepath: Path, items: List[Dict]):
+        """用items整体重写JSONL文件（原子替换，崩溃时保留旧文件）"""
+        write_atomic(filepath, b''.join(json_util.dumps(item) + b'\n' for item in items))
 
     def get_context_for_ai(self, conversation_id: str) -> List[Dict]:
         """
@@ -240,31 +544,26 @@ class ConversationManager:
             return []
 
         try:
-            # 1. 读取archive（压缩记忆）
-            archive_file = conv_dir / "archive.json"
-            archive = []
-            if archive_file.exists():
-                with open(archive_file, 'r', encoding='utf-8') as f:
-                    archive = json.load(f)
+            # 1. 读取archive（压缩记忆）的后8条
+            memory = self._tail_jsonl(conv_dir / "archive.jsonl", 8)
 
             # 2. 读取tactical（当前上下文）
-            tactical_file = conv_dir / "tactical.json"
-            tactical = []
-            if tactical_file.exists():
-                with open(tactical_file, 'r', encoding='utf-8') as f:
-                    tactical = json.load(f)
+            tactical = self._get_tactical(conversation_id)
 
             # 3. 合并：archive后8条 + tactical全部
-            memory = archive[-8:] if len(archive) >= 8 else archive
             combined_context = memory + tactical
 
-            logger.debug(f"为对话 {conversation_id} 准备上下文: {len(memory)}记忆 + {len(tactical)}当前")
+            logger.debug("为对话 %s 准备上下文: %s记忆 + %s当前", conversation_id, len(memory), len(tactical))
             return combined_context
 
         except Exception as e:
             logger.error(f"获取上下文失败: {e}")
             return []
 
+    def get_metadata(self, conversation_id: str) -> Optional[Dict]:
+        """获取对话元数据（只查内存，不读历史文件），对话不存在时返回None"""
+        return self.conversations.get(conversation_id)
+
     def get_conversation_context(self, conversation_id: str) -> Dict[str, Any]:
         """
         获取对话的完整上下文数据
@@ -286,13 +585,14 @@ class ConversationManager:
 
         context = {"metadata": self.conversations[conversation_id]}
 
-        for filename in ["tactical", "archive", "raw_context"]:
-            filepath = conv_dir / f"{filename}.json"
-            if filepath.exists():
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    context[filename] = json.load(f)
-            else:
-                context[filename] = []
+        # 三个文件并行读取（先把这个对话还没写盘的消息写完）
+        self.flush(conversation_id)
+        futures = {
+            name: _io_pool.submit(self._read_jsonl, conv_dir / f"{name}.jsonl")
+            for name in HISTORY_FILES
+        }
+        for name, future in futures.items():
+            context[name] = future.result()
 
         return context
 
@@ -301,15 +601,9 @@ class ConversationManager:
         if conversation_id not in self.conversations:
             return []
 
-        conv_dir = self.base_dir / conversation_id
-        tactical_file = conv_dir / "tactical.json"
-
-        if not tactical_file.exists():
-            return []
-
         try:
-            with open(tactical_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with self._history_lock:
+                return list(self._get_tactical(conversation_id))
         except Exception as e:
             logger.error(f"读取tactical失败: {e}")
             return []
@@ -318,7 +612,8 @@ class ConversationManager:
             self,
             conversation_id: str,
             compressed_summary: str,
-            keep_recent_messages: int = 5
+            keep_recent_messages: int = 5,
+            compressed_count: Optional[int] = None
     ) -> bool:
         """
         压缩后更新对话数据
@@ -326,7 +621,9 @@ class ConversationManager:
         Args:
             conversation_id: 对话ID
             compressed_summary: 压缩后的摘要内容
-            keep_recent_messages: 保留最近的消息条数
+            keep_recent_messages: 保留最近的消息条数（没有给出compressed_count时使用）
+            compressed_count: 被压缩的是tactical开头的多少条消息
+                              （压缩期间新追加的消息都在末尾，会原样保留）
 
         Returns:
             是否成功
@@ -339,43 +636,39 @@ class ConversationManager:
             return False
 
         try:
-            # 1. 读取当前tactical
-            tactical_file = conv_dir / "tactical.json"
-            tactical = []
-            if tactical_file.exists():
-                with open(tactical_file, 'r', encoding='utf-8') as f:
-                    tactical = json.load(f)
-
-            if len(tactical) <= keep_recent_messages:
-                # 消息太少，不需要压缩，但还是重置interval
-                logger.info(f"对话 {conversation_id} 消息太少 ({len(tactical)}条)，跳过压缩")
-                return True
-
-            # 2. 保留最近的消息，压缩之前的消息
-            to_keep = tactical[-keep_recent_messages:]  # 保留最近的N条
-            to_compress = tactical[:-keep_recent_messages]  # 压缩之前的
-
-            # 3. 将压缩摘要添加到archive
-            archive_file = conv_dir / "archive.json"
-            archive = []
-            if archive_file.exists():
-                with open(archive_file, 'r', encoding='utf-8') as f:
-                    archive = json.load(f)
-
-            archive.append({
-                "type": "compressed",
-                "content": compressed_summary,
-                "original_count": len(to_compress),
-                "timestamp": int(time.time())
-            })
-
-            # 保存archive
-            with open(archive_file, 'w', encoding='utf-8') as f:
-                json.dump(archive, f, ensure_ascii=False, indent=2)
-
-            # 4. 更新tactical为保留的消息
-            with open(tactical_file, 'w', encoding='utf-8') as f:
-                json.dump(to_keep, f, ensure_ascii=False, indent=2)
+            with self._history_lock:
+                # 改写tactical前先把排队的追加写完，免得之后又被追加到新文件里
+                if not self.flush(conversation_id):
+                    logger.error(f"对话 {conversation_id} 有未能写盘的消息，跳过本次压缩")
+                    return False
+
+                # 1. 读取当前tactical
+                tactical_file = conv_dir / "tactical.jsonl"
+                tactical = self._get_tactical(conversation_id)
+
+                if compressed_count is None:
+                    compressed_count = len(tactical) - keep_recent_messages
+                if compressed_count <= 0:
+                    # 消息太少，不需要压缩
+                    logger.info(f"对话 {conversation_id} 消息太少 ({len(tactical)}条)，跳过压缩")
+                    return True
+
+                # 2. 压缩前面的消息，保留之后的
+                to_compress = tactical[:compressed_count]
+                to_keep = tactical[compressed_count:]
+
+                # 3. 将压缩摘要追加到archive
+                self._append_to_file(conv_dir / "archive.jsonl", {
+                    "type": "compressed",
+                    "content": compressed_summary,
+                    "original_count": len(to_compress),
+                    "timestamp": int(time.time())
+                })
+
+                # 4. 更新tactical为保留的消息
+                self._write_jsonl(tactical_file, to_keep)
+                self._tactical_cache[conversation_id] = to_keep
+                self._context_versions[conversation_id] = self.get_context_version(conversation_id) + 1
 
             # 5. 记录日志
             logger.info(
@@ -390,11 +683,7 @@ class ConversationManager:
     def list_conversations(self, device_id: Optional[str] = None) -> Dict:
         """列出对话列表"""
         if device_id:
-            return {
-                conv_id: meta
-                for conv_id, meta in self.conversations.items()
-                if meta.get("device") == device_id
-            }
+            return dict(self._by_device.get(device_id, {}))
         return self.conversations.copy()
 
     def delete_conversation(self, conversation_id: str) -> bool:
@@ -402,7 +691,8 @@ class ConversationManager:
         if conversation_id not in self.conversations:
             return False
 
-        # 删除文件夹
+        # 删除文件夹（先丢掉排队的追加，免得删除后又把目录下的文件建出来）
+        self._discard_pending(conversation_id)
         conv_dir = self.base_dir / conversation_id
         if conv_dir.exists():
             import shutil
@@ -413,8 +703,14 @@ class ConversationManager:
                 return False
 
         # 删除元数据
-        del self.conversations[conversation_id]
-        return self._save_metadata()
+        self._tactical_cache.pop(conversation_id, None)
+        self._context_versions.pop(conversation_id, None)
+        with self._lock:
+            meta = self.conversations.pop(conversation_id, None)
+            if meta is not None:
+                self._by_device[meta.get("device")].pop(conversation_id, None)
+        self._mark_dirty()
+        return self._maybe_flush(force=True)
 
 
 # 全局实例
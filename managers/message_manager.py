@@ -1,19 +1,29 @@
-from typing import Dict, Any
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+from utils import json_util
 from utils.ai_response_util import extract_ai_response
 from utils.logger import logger
-from utils.payload_util import generate_payload
+from utils.payload_util import convert_context, generate_payload
 
 from .conversation_manager import conversation_manager
-from .ai_manager import ai_manager
+from .ai_manager import get_ai_manager
 
+# 最多缓存多少个对话的已转换上下文
+CONTEXT_CACHE_SIZE = 256
 
 
 class MessageManager:
     """消息管理器 - 只协调消息处理流程"""
 
     def __init__(self):
-        pass  # 不存储状态，只调用其他模块
+        # 对话ID -> (上下文版本, 已转换成接口格式的上下文)
+        # 只缓存转换结果，对话数据本身还是由其他模块管理
+        self._msg_cache: Dict[str, Tuple[int, List[Dict]]] = {}
+        # 对话ID -> (上次的tools, 序列化好的tools)
+        # 客户端每轮都会带上同一份tools，没变就直接复用上次序列化的结果
+        self._tools_blob_cache: Dict[str, Tuple[List, json_util.RawJSON]] = {}
+        self._cache_lock = threading.Lock()
 
     def process_message(self, data: Dict) -> Dict[str, Any]:
         """
@@ -43,89 +53,30 @@ class MessageManager:
             }
         """
         try:
-            logger.info(f"处理消息: conversation={data.get('conversation')}")
-
-            # 1. 验证必需字段
-            conversation = data.get("conversation")
-            device = data.get("device")
-            message = data.get("message")
-
-            if not conversation or not device:
-                return self._error("缺少conversation或device")
-
-            # 2. 获取对话上下文
-            context_data = conversation_manager.get_conversation_context(conversation)
-            if not context_data:
-                return self._error(f"对话不存在: {conversation}")
-
-            metadata = context_data["metadata"]
-
-            # 3. 处理工具响应（如果有）
-            tool_response = data.get("tool_response")
-            if tool_response:
-                # 保存为role: "tool"的消息
-                success = conversation_manager.add_message(
-                    conversation_id=conversation,
-                    role="tool",
-                    content=tool_response.get("content", ""),
-                    tool_call_id=tool_response.get("tool_call_id")
-                )
-                if not success:
-                    logger.warning(f"保存tool_response失败: {tool_response}")
-
-            # 4. 保存用户消息（如果有文本内容）
-            if message and isinstance(message, str) and message.strip():
-                success = conversation_manager.add_message(
-                    conversation_id=conversation,
-                    role="user",
-                    content=message
-                )
-                if not success:
-                    return self._error("保存用户消息失败")
-
-            # 5. 获取AI配置
-            ai_config = ai_manager.get(metadata["ai"])
-            if not ai_config:
-                return self._error(f"AI配置不存在: {metadata['ai']}")
-
-            provider = ai_config.get("provider", "openai")
-
-            # 6. 获取用于AI的上下文（包含所有历史消息，包括刚添加的tool_response）
-            ai_context = conversation_manager.get_context_for_ai(conversation)
-
-            # 7. 生成payload
-            tools = data.get("tools")
-            payload = generate_payload(
-                prompt_type=metadata["prompt"],
-                messages=[message] if isinstance(message, str) and message.strip() else [],
-                role="user",
-                context=ai_context,
-                ai=metadata["ai"],
-                device=device,
-                tools=tools
-            )
+            prepared, error = self._prepare(data)
+            if error:
+                return self._error(error)
 
-            if not payload:
-                return self._error("生成请求参数失败")
+            conversation = prepared["conversation"]
 
             # 8. 调用AI服务
-            ai_response = ai_manager.call_ai(ai_config, payload)
+            ai_response = get_ai_manager().call_ai(prepared["ai_config"], prepared["payload"])
             if not ai_response:
                 return self._error("AI服务无响应")
 
             # 9. 提取AI响应
-            extracted = extract_ai_response(ai_response, provider)
-            if not extracted:
+            extracted = extract_ai_response(ai_response, prepared["provider"])
+            if extracted is None:
                 return self._error("解析AI响应失败")
 
             # 10. 保存AI回复
             success = conversation_manager.add_message(
                 conversation_id=conversation,
                 role="assistant",
-                content=extracted.get("message", ""),
-                tool_calls=extracted.get("tools", []),
-                finish_reason=extracted.get("reason"),
-                total_tokens=extracted.get("tokens", 0)
+                content=extracted.message,
+                tool_calls=extracted.tools,
+                finish_reason=extracted.reason,
+                total_tokens=extracted.tokens
             )
 
             if not success:
@@ -133,16 +84,274 @@ class MessageManager:
 
             # 11. 返回给客户端
             return self._success({
-                "content": extracted.get("message", ""),
-                "tool_calls": extracted.get("tools", []),
-                "finish_reason": extracted.get("reason", "unknown")
+                "content": extracted.message,
+                "tool_calls": extracted.tools,
+                "finish_reason": extracted.reason
             })
 
         except Exception as e:
             logger.error(f"处理消息失败: {e}", exc_info=True)
             return self._error(f"服务器错误: {str(e)}")
 
+    def stream_message(self, data: Dict) -> Iterator[Dict[str, Any]]:
+        """
+        流式处理一条消息，AI回复一边生成一边产出
+
+        Args:
+            data: 同process_message
+
+        Yields:
+            {"content": "增量文本"}                      # 生成过程中的每一块
+            {"content": "", "tool_calls": [], "finish_reason": "stop", "done": True}  # 结束
+            {"error": "错误信息", "done": True}            # 失败
+        """
+        try:
+            prepared, error = self._prepare(data)
+            if error:
+                yield {"error": error, "done": True}
+                return
+
+            is_ollama = prepared["provider"] == "ollama"
+            if is_ollama:
+                payload = dict(prepared["payload"], stream=True)
+            else:
+                # 让OpenAI兼容接口在最后一块里带上token用量
+                payload = dict(prepared["payload"], stream=True, stream_options={"include_usage": True})
+
+            content_parts = []
+            tool_calls = {}
+            finish_reason = "unknown"
+            total_tokens = 0
+
+            for chunk in get_ai_manager().stream_ai(prepared["ai_config"], payload):
+                if is_ollama:
+                    chunk = self._ollama_chunk(chunk, len(tool_calls))
+
+                usage = chunk.get("usage")
+                if usage:
+                    total_tokens = usage.get("total_tokens", 0)
+
+                choices = chunk.get("choices")
+                if not choices:
+                    continue
+
+                choice = choices[0]
+                delta = choice.get("delta") or {}
+
+                text = delta.get("content")
+                if text:
+                    content_parts.append(text)
+                    yield {"content": text}
+
+                for call in delta.get("tool_calls") or []:
+                    self._merge_tool_call(tool_calls, call)
+
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+
+            content = "".join(content_parts)
+            tools = [tool_calls[i] for i in sorted(tool_calls)]
+            if is_ollama and tools and finish_reason == "stop":
+                # ollama调用工具时done_reason也是stop，客户端要靠tool_calls判断去执行工具
+                finish_reason = "tool_calls"
+
+            # 生成结束后再保存完整的AI回复
+            success = conversation_manager.add_message(
+                conversation_id=prepared["conversation"],
+                role="assistant",
+                content=content,
+                tool_calls=tools,
+                finish_reason=finish_reason,
+                total_tokens=total_tokens
+            )
+
+            if not success:
+                logger.warning("保存AI回复失败，但继续返回响应")
+
+            yield {
+                "content": "",
+                "tool_calls": tools,
+                "finish_reason": finish_reason,
+                "done": True
+            }
+
+        except Exception as e:
+            logger.error(f"流式处理消息失败: {e}", exc_info=True)
+            yield {"error": f"服务器错误: {str(e)}", "done": True}
+
+    def _prepare(self, data: Dict) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        保存本轮的用户消息/工具响应并生成请求AI的payload
+
+        Returns:
+            (prepared, error): 成功时error为None，prepared包含
+            conversation、ai_config、provider、payload
+        """
+        logger.info("处理消息: conversation=%s", data.get('conversation'))
+
+        # 1. 验证必需字段
+        conversation = data.get("conversation")
+        device = data.get("device")
+        message = data.get("message")
+
+        if not conversation or not device:
+            return None, "缺少conversation或device"
+
+        # 2. 获取对话元数据（不读历史文件）
+        metadata = conversation_manager.get_metadata(conversation)
+        if not metadata:
+            return None, f"对话不存在: {conversation}"
+
+        # 3. 处理工具响应（如果有），保存为role: "tool"的消息
+        new_messages = []
+        tool_response = data.get("tool_response")
+        if tool_response:
+            new_messages.append({
+                "role": "tool",
+                "content": tool_response.get("content", ""),
+                "tool_call_id": tool_response.get("tool_call_id")
+            })
+
+        # 4. 保存用户消息（如果有文本内容），和工具响应一起写入
+        if message and isinstance(message, str) and message.strip():
+            new_messages.append({"role": "user", "content": message})
+
+        saved = len(new_messages)
+        if new_messages and not conversation_manager.add_messages(conversation, new_messages):
+            if new_messages[-1]["role"] == "user":
+                return None, "保存用户消息失败"
+            logger.warning("保存tool_response失败: %s", tool_response)
+            saved = 0
+
+        # 5. 获取AI配置
+        ai_config = get_ai_manager().get(metadata["ai"])
+        if not ai_config:
+            return None, f"AI配置不存在: {metadata['ai']}"
+
+        provider = ai_config.get("provider", "openai")
+
+        # 6. 获取用于AI的上下文（包含所有历史消息，包括刚添加的tool_response）
+        # 版本号要在读上下文之前取：中间刚好压缩完的话，旧版本号对不上缓存，下一轮会整份重新转换
+        # 反过来先读上下文再取版本号，压缩前的上下文会被当成压缩后的版本缓存起来
+        version = conversation_manager.get_context_version(conversation)
+        ai_context = conversation_manager.get_context_for_ai(conversation)
+
+        # 7. 生成payload
+        # 本轮刚保存的消息已经在上下文末尾，拆出来作为新消息，放在设备标记后面（不再重复发送一遍）
+        converted = self._convert_context(conversation, version, ai_context)
+        split = len(converted) - saved
+        tools = data.get("tools")
+        payload = generate_payload(
+            prompt_type=metadata["prompt"],
+            messages=converted[split:],
+            role="user",
+            context=converted[:split],
+            ai_config=ai_config,
+            device=device,
+            tools=self._serialize_tools(conversation, tools)
+        )
+
+        if not payload:
+            return None, "生成请求参数失败"
+
+        return {
+            "conversation": conversation,
+            "ai_config": ai_config,
+            "provider": provider,
+            "payload": payload
+        }, None
 
+    def _convert_context(self, conversation_id: str, version: int, context: List[Dict]) -> List[Dict]:
+        """
+        把上下文转换成接口格式
+
+        同一版本内上下文只会在末尾追加，所以复用上一轮转换好的前缀，只转换新增的消息
+        version必须是读取context之前取到的版本号
+        """
+        cached = self._msg_cache.get(conversation_id)
+
+        if cached is not None and cached[0] == version and len(cached[1]) <= len(context):
+            prefix = cached[1]
+            converted = prefix + convert_context(context[len(prefix):])
+        else:
+            converted = convert_context(context)
+
+        with self._cache_lock:
+            if conversation_id not in self._msg_cache and len(self._msg_cache) >= CONTEXT_CACHE_SIZE:
+                # 满了就丢掉最早放进来的
+                del self._msg_cache[next(iter(self._msg_cache))]
+            self._msg_cache[conversation_id] = (version, converted)
+
+        return converted
+
+    def _serialize_tools(self, conversation_id: str, tools: Optional[List]) -> Optional[json_util.RawJSON]:
+        """把tools序列化成RawJSON，和上一轮相同时复用缓存"""
+        if not tools:
+            return None
+
+        cached = self._tools_blob_cache.get(conversation_id)
+        if cached is not None and cached[0] == tools:
+            return cached[1]
+
+        blob = json_util.RawJSON.of(tools)
+        with self._cache_lock:
+            if conversation_id not in self._tools_blob_cache and len(self._tools_blob_cache) >= CONTEXT_CACHE_SIZE:
+                del self._tools_blob_cache[next(iter(self._tools_blob_cache))]
+            self._tools_blob_cache[conversation_id] = (tools, blob)
+        return blob
+
+    @staticmethod
+    def _ollama_chunk(chunk: Dict, call_offset: int) -> Dict:
+        """
+        把ollama的流式数据块({"message": {...}, "done": ...})转换成OpenAI的chunk格式
+
+        ollama的工具调用每次都是完整的一条，参数是对象；call_offset是之前已经收到的工具调用数量
+        """
+        message = chunk.get("message") or {}
+        delta = {"content": message.get("content", "")}
+
+        calls = []
+        for i, call in enumerate(message.get("tool_calls") or [], call_offset):
+            function = call.get("function") or {}
+            arguments = function.get("arguments", "")
+            if not isinstance(arguments, str):
+                arguments = json_util.dumps(arguments).decode("utf-8")
+            calls.append({
+                "index": i,
+                "id": call.get("id") or f"call_{i}",
+                "type": "function",
+                "function": {"name": function.get("name", ""), "arguments": arguments}
+            })
+        if calls:
+            delta["tool_calls"] = calls
+
+        converted = {"choices": [{"delta": delta, "finish_reason": None}]}
+        if chunk.get("done"):
+            converted["choices"][0]["finish_reason"] = chunk.get("done_reason") or "stop"
+            converted["usage"] = {
+                "total_tokens": chunk.get("prompt_eval_count", 0) + chunk.get("eval_count", 0)
+            }
+        return converted
+
+    @staticmethod
+    def _merge_tool_call(tool_calls: Dict[int, Dict], delta: Dict):
+        """把流式返回的工具调用片段按index拼成完整的tool_call"""
+        call = tool_calls.setdefault(delta.get("index", 0), {
+            "id": "",
+            "type": "function",
+            "function": {"name": "", "arguments": ""}
+        })
+
+        if delta.get("id"):
+            call["id"] = delta["id"]
+        if delta.get("type"):
+            call["type"] = delta["type"]
+
+        function = delta.get("function") or {}
+        if function.get("name"):
+            call["function"]["name"] += function["name"]
+        if function.get("arguments"):
+            call["function"]["arguments"] += function["arguments"]
 
     def _success(self, response_data: Dict) -> Dict[str, Any]:
         """成功响应"""
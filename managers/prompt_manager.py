@@ -1,7 +1,8 @@
-import json
 import time
 from pathlib import Path
 
+from utils import json_util
+from utils.file_utils import ensure_dir, write_atomic
 from utils.logger import logger
 
 
@@ -10,10 +11,14 @@ class PromptManager:
 
     def __init__(self, config_dir: str = "data"):
         self.config_dir = Path(config_dir)
-        self.config_dir.mkdir(parents=True, exist_ok=True)
+        ensure_dir(str(self.config_dir))
 
         self.prompts_file = self.config_dir / "prompts.json"
         self.prompts = self._load_prompts()
+        # 每次修改+1，用于判断缓存是否过期
+        self.version = 0
+        # prompt_type -> 拼好的完整prompt，修改prompts时清空
+        self._full_prompt_cache = {}
 
     def _load_prompts(self) -> dict:
         """加载prompts"""
@@ -21,17 +26,18 @@ class PromptManager:
             return {"common": {"prompt": "You are a helpful AI assistant."}}
 
         try:
-            with open(self.prompts_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(self.prompts_file, 'rb') as f:
+                return json_util.loads(f.read())
         except Exception as e:
             logger.error(f"加载prompts失败: {e}")
             return {"common": {"prompt": "You are a helpful AI assistant."}}
 
     def _save_prompts(self) -> bool:
         """保存prompts"""
+        self.version += 1
+        self._full_prompt_cache.clear()
         try:
-            with open(self.prompts_file, 'w', encoding='utf-8') as f:
-                json.dump(self.prompts, f, ensure_ascii=False, indent=2)
+            write_atomic(self.prompts_file, json_util.dumps(self.prompts, indent=True))
             return True
         except Exception as e:
             logger.error(f"保存prompts失败: {e}")
@@ -41,6 +47,9 @@ class PromptManager:
         """设置common prompt"""
         if "common" not in self.prompts:
             self.prompts["common"] = {}
+        elif self.prompts["common"].get("prompt") == prompt:
+            # 内容没变，不更新时间也不写盘
+            return True
 
         self.prompts["common"]["prompt"] = prompt
         self.prompts["common"]["updated"] = int(time.time())
@@ -51,6 +60,9 @@ class PromptManager:
         if name not in self.prompts:
             self.prompts[name] = {}
             self.prompts[name]["created"] = int(time.time())
+        elif self.prompts[name].get("prompt") == prompt:
+            # 内容没变，不更新时间也不写盘
+            return True
 
         self.prompts[name]["prompt"] = prompt
         self.prompts[name]["updated"] = int(time.time())
@@ -63,14 +75,21 @@ class PromptManager:
         return ""
 
     def get_full_prompt(self, prompt_type: str) -> str:
-        """获取完整prompt（common + 指定类型）"""
+        """获取完整prompt（common + 指定类型），结果会被缓存"""
+        cached = self._full_prompt_cache.get(prompt_type)
+        if cached is not None:
+            return cached
+
         common = self.get_prompt("common")
         specific = self.get_prompt(prompt_type)
 
         if not specific or prompt_type == "common":
-            return common
+            full = common
+        else:
+            full = f"{common}\n\n{specific}"
 
-        return f"{common}\n\n{specific}"
+        self._full_prompt_cache[prompt_type] = full
+        return full
 
     def list_prompts(self) -> dict:
         """列出所有prompts（不包含common）"""
@@ -1,8 +1,21 @@
 
+from dataclasses import dataclass, field
+from typing import Optional
+
 from utils.logger import logger
 
 
-def extract_openai_response(ai_response: dict):
+@dataclass(slots=True)
+class Extracted:
+    """从AI响应中提取出的核心数据"""
+    message: str = ""                         # content -> message
+    tools: list = field(default_factory=list)  # tool_calls -> tools
+    reason: str = "unknown"                   # finish_reason -> reason
+    tokens: int = 0                           # usage.total_tokens -> tokens
+    raw: Optional[dict] = None                # 提取失败时保留原始响应以便调试
+
+
+def extract_openai_response(ai_response: dict) -> Extracted:
     """
     从OpenAI兼容格式的响应中提取核心数据
 
@@ -10,20 +23,9 @@ def extract_openai_response(ai_response: dict):
         ai_response: OpenAI格式的AI响应字典
 
     Returns:
-        提取后的数据:
-        {
-            "message": "文本内容",              # content
-            "tools": [],                       # tool_calls
-            "reason": "stop",                  # finish_reason
-            "tokens": 100                      # usage.total_tokens
-        }
+        提取后的数据(Extracted)
     """
-    result = {
-        "message": "",      # content -> message
-        "tools": [],        # tool_calls -> tools
-        "reason": "unknown", # finish_reason -> reason
-        "tokens": 0         # usage.total_tokens -> tokens
-    }
+    result = Extracted()
 
     try:
         # 1. 检查choices字段
@@ -35,42 +37,49 @@ def extract_openai_response(ai_response: dict):
         message = choice.get("message", {})
 
         # 2. 提取message (content)
-        result["message"] = message.get("content", "") or ""
+        result.message = message.get("content", "") or ""
 
         # 3. 提取tools (tool_calls)
         if "tool_calls" in message and message["tool_calls"]:
-            result["tools"] = message["tool_calls"]
+            result.tools = message["tool_calls"]
 
         # 4. 提取reason (finish_reason)
-        result["reason"] = choice.get("finish_reason", "unknown")
+        result.reason = choice.get("finish_reason", "unknown")
 
         # 5. 提取tokens (usage.total_tokens)
         if "usage" in ai_response:
             usage = ai_response["usage"]
-            result["tokens"] = usage.get("total_tokens", 0)
+            result.tokens = usage.get("total_tokens", 0)
 
             # 记录到日志
             prompt_tokens = usage.get("prompt_tokens", 0)
             completion_tokens = usage.get("completion_tokens", 0)
-            logger.info(f"[Token使用] 本次请求: {result['tokens']}总tokens "
-                        f"({prompt_tokens}输入 + {completion_tokens}输出)")
+            logger.info("[Token使用] 本次请求: %s总tokens (%s输入 + %s输出)",
+                        result.tokens, prompt_tokens, completion_tokens)
 
         # 6. 记录提取结果到日志
-        logger.debug(f"提取AI响应: {len(result['message'])}字符, "
-                     f"{len(result['tools'])}个工具调用, "
-                     f"原因: {result['reason']}")
+        logger.debug("提取AI响应: %s字符, %s个工具调用, 原因: %s",
+                     len(result.message), len(result.tools), result.reason)
 
     except Exception as e:
         logger.error(f"提取OpenAI响应失败: {e}")
         # 保留原始响应以便调试
-        result["_raw"] = ai_response
+        result.raw = ai_response
 
-    logger.debug(f"收到AI回复:{result}")
+    logger.debug("收到AI回复:%s", result)
     return result
 
-def extract_ai_response(ai_response: dict, provider: str):
-    response = {}
-    if provider in ("openai", "deepseek", "ollama", "siliconflow"):
-        response = extract_openai_response(ai_response)
-
-    return response
\ No newline at end of file
+# provider -> 提取函数
+_EXTRACTORS = {
+    "openai": extract_openai_response,
+    "deepseek": extract_openai_response,
+    "ollama": extract_openai_response,
+    "siliconflow": extract_openai_response,
+}
+
+def extract_ai_response(ai_response: dict, provider: str) -> Optional[Extracted]:
+    """按provider提取AI响应，不支持的provider返回None"""
+    extractor = _EXTRACTORS.get(provider)
+    if extractor is None:
+        return None
+    return extractor(ai_response)
\ No newline at end of file
@@ -1,7 +1,9 @@
+import hmac
 import uuid
-import json
 from pathlib import Path
 
+from utils import json_util
+from utils.file_utils import ensure_dir, write_atomic
 from utils.logger import logger
 
 
@@ -11,17 +13,33 @@ class ApiKeyManager:
     def __init__(self, key_file: str = "data/api_key.json"):
         self.key_file = Path(key_file)
         self.key: str = ""
+        # 预先算好的密钥字节，验证时不用每次再解析一遍
+        self._key_bytes: bytes = b""
+        # 密钥变化时要调用的函数（比如清掉已验证密钥的缓存）
+        self._listeners = []
         self._load_or_create()
 
+    def on_change(self, callback):
+        """注册密钥变化时的回调（无参数）"""
+        self._listeners.append(callback)
+
+    def _set_key(self, key: str):
+        """更换当前密钥并通知监听者"""
+        self.key = key
+        self._key_bytes = self._normalize(key) if key else b""
+        for callback in self._listeners:
+            callback()
+
     def _load_or_create(self):
         """加载或创建API密钥"""
         try:
             if self.key_file.exists():
-                with open(self.key_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.key = data.get('api_key', '')
+                with open(self.key_file, 'rb') as f:
+                    data = json_util.loads(f.read())
+                    key = data.get('api_key', '')
 
-                if self.key:
+                if key:
+                    self._set_key(key)
                     logger.info(f"已加载API密钥: {self.key[:8]}...")
                 else:
                     logger.warning("密钥文件格式错误，重新生成")
@@ -33,27 +51,49 @@ class ApiKeyManager:
             logger.error(f"加载密钥失败: {e}")
             self._generate_key()
 
+    def rotate(self) -> str:
+        """更换API密钥，旧密钥立即失效，返回新密钥"""
+        self._generate_key()
+        return self.key
+
     def _generate_key(self):
-        """生成新密钥"""
-        self.key = str(uuid.uuid4())
+        """生成新密钥（先写文件，写成功了才换掉内存里的密钥）"""
+        key = str(uuid.uuid4())
         data = {
-            "api_key": self.key
+            "api_key": key
         }
 
-        self.key_file.parent.mkdir(parents=True, exist_ok=True)
-        with open(self.key_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
+        ensure_dir(str(self.key_file.parent))
+        write_atomic(self.key_file, json_util.dumps(data, indent=True))
+        self._set_key(key)
 
         logger.info(f" 新API密钥已生成: {self.key},保存至data/api_key.json")
         logger.info(" 使用示例:")
         logger.info(f"   curl -H 'X-API-Key: {self.key}' http://localhost:5000/health")
         logger.info(f"   或 curl 'http://localhost:5000/health?key={self.key}'")
 
+    @staticmethod
+    def _normalize(key: str) -> bytes:
+        """UUID格式的密钥按UUID比较（不区分大小写、有没有横杠），其他格式按原文比较"""
+        # 常见写法（32位十六进制，带或不带横杠）直接转成字节，不用构造UUID对象
+        compact = key.replace("-", "")
+        if len(compact) == 32:
+            try:
+                return bytes.fromhex(compact)
+            except ValueError:
+                pass
+
+        try:
+            # 带花括号、urn:uuid:前缀之类的写法
+            return uuid.UUID(key).bytes
+        except ValueError:
+            return key.encode("utf-8")
+
     def validate(self, provided_key: str) -> bool:
-        """验证API密钥"""
-        if not provided_key:
+        """验证API密钥（常数时间比较，格式不对直接返回False）"""
+        if not provided_key or not self._key_bytes:
             return False
-        return uuid.UUID(provided_key) == uuid.UUID(self.key)
+        return hmac.compare_digest(self._normalize(provided_key), self._key_bytes)
 
 
 # 全局密钥管理器实例
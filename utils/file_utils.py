@@ -1,4 +1,10 @@
-import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from utils import json_util
+
+
 class FileReadError(Exception):
     """自定义文件读取异常"""
     pass
@@ -37,8 +43,41 @@ def read_json(path, encoding: str = "utf-8"):
     :param encoding: defaults to utf-8(str)
     :return: JSON(Any)
     """
-    text = read_text(path, encoding)
+    if encoding.lower() in ("utf-8", "utf8"):
+        # 直接解析原始字节, 省掉一次整文件decode
+        data = read_raw(path)
+    else:
+        data = read_text(path, encoding)
+    try:
+        return json_util.loads(data)
+    except ValueError as e:
+        raise FileReadError(f"JSON解析失败 {path}: {e}")
+
+# ==================== 基础写入 ====================
+@lru_cache(maxsize=32)
+def ensure_dir(path: str):
+    """
+    确保目录存在, 同一路径每个进程只mkdir一次
+    :param path: DirPath(str)
+    """
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+
+def write_atomic(path, data: bytes):
+    """
+    原子写入: 先写到同目录的临时文件并fsync, 再用os.replace替换目标文件
+    写到一半崩溃也不会留下被截断的文件
+    :param path: FilePath(str/Path)
+    :param data: rawBytes(bytes)
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
     try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
-        raise FileReadError(f"JSON解析失败 {path}: {e}")
\ No newline at end of file
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+        raise
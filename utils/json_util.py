@@ -0,0 +1,92 @@
+import json
+from types import MappingProxyType
+
+try:
+    import orjson
+except ImportError:  # 没装orjson时回退到标准库
+    orjson = None
+
+
+class RawJSON:
+    """已经序列化好的JSON片段, 作为AI请求体顶层的值传给dumps_payload时原样拼进去, 不再重新序列化"""
+    __slots__ = ("blob",)
+
+    def __init__(self, blob: bytes):
+        self.blob = blob
+
+    @classmethod
+    def of(cls, obj) -> "RawJSON":
+        return cls(dumps(obj))
+
+
+def _default(obj):
+    """序列化标准JSON类型以外的对象"""
+    if isinstance(obj, MappingProxyType):
+        return dict(obj)
+    if isinstance(obj, RawJSON):
+        # 不在dumps_payload的顶层时没法直接拼接, 解析回来重新序列化
+        return loads(obj.blob)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+# 标准库回退时复用编码器，json.dumps带参数调用时每次都会新建JSONEncoder
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+_indent_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, indent=2)
+_sorted_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+
+def loads(data):
+    """
+    解析JSON
+    :param data: JSON文本(str/bytes/memoryview)
+    :return: JSON(Any)
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def dumps(obj, indent: bool = False, sort_keys: bool = False) -> bytes:
+    """
+    序列化为UTF-8编码的JSON(中文不转义)
+    :param obj: 要序列化的对象
+    :param indent: 是否缩进2格(给人看的文件用)
+    :param sort_keys: 是否按键名排序(内容相同的对象得到相同的字节, 用来算缓存key), 不能和indent同时用
+    :return: jsonBytes(bytes)
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_default, option=option)
+
+    if sort_keys:
+        encoder = _sorted_encoder
+    else:
+        encoder = _indent_encoder if indent else _encoder
+    return encoder.encode(obj).encode("utf-8")
+
+
+def dumps_payload(payload: dict, sort_keys: bool = False) -> bytes:
+    """
+    序列化AI请求体, 顶层的RawJSON值(预先序列化好的tools等)直接拼进去
+    :param payload: 请求体
+    :param sort_keys: 同dumps, RawJSON的键拼在最后
+    :return: jsonBytes(bytes)
+    """
+    raw = [k for k, v in payload.items() if isinstance(v, RawJSON)]
+    if not raw:
+        return dumps(payload, sort_keys=sort_keys)
+
+    rest = {k: v for k, v in payload.items() if k not in raw}
+    parts = [dumps(rest, sort_keys=sort_keys)[:-1]]
+    for i, k in enumerate(raw):
+        if i or rest:
+            parts.append(b",")
+        parts.append(dumps(k) + b":" + payload[k].blob)
+    parts.append(b"}")
+    return b"".join(parts)
@@ -0,0 +1,56 @@
+"""
+AI回复缓存 - 完全相同的请求直接返回上次的回复，不再请求一次AI
+"""
+import hashlib
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# 缓存有效期（秒）
+CACHE_TTL = 600
+
+# 最多缓存多少条回复
+CACHE_MAX_SIZE = 4096
+
+# key -> (过期时间, AI回复)
+_cache: Dict[bytes, Tuple[float, dict]] = {}
+_lock = threading.Lock()
+
+
+def make_key(url: str, body: bytes) -> bytes:
+    """
+    计算缓存key
+    :param url: 请求地址
+    :param body: 按键名排序序列化后的请求体(json_util.dumps(payload, sort_keys=True))
+    :return: key(bytes)
+    """
+    digest = hashlib.sha256(url.encode("utf-8"))
+    digest.update(body)
+    return digest.digest()[:16]
+
+
+def get(key: bytes) -> Optional[dict]:
+    """取出缓存的回复，没有或已过期时返回None"""
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+
+    if entry[0] < time.monotonic():
+        with _lock:
+            _cache.pop(key, None)
+        return None
+
+    return entry[1]
+
+
+def put(key: bytes, response: dict):
+    """缓存一条回复"""
+    now = time.monotonic()
+    with _lock:
+        if key not in _cache and len(_cache) >= CACHE_MAX_SIZE:
+            # 先清掉过期的，还是满的话丢掉最早放进来的
+            for expired in [k for k, (expire_at, _) in _cache.items() if expire_at < now]:
+                del _cache[expired]
+            if len(_cache) >= CACHE_MAX_SIZE:
+                del _cache[next(iter(_cache))]
+        _cache[key] = (now + CACHE_TTL, response)
@@ -1,18 +1,41 @@
+import atexit
 import logging
+import queue
 import sys
 import os
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # 创建 logs 目录（如果不存在）
 os.makedirs('logs', exist_ok=True)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
+
+def _setup():
+    """把根logger接到后台写日志的队列上"""
+    formatter = logging.Formatter(
+        '[%(asctime)s] [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    handlers = [
         logging.StreamHandler(sys.stdout),  # 输出到控制台
-        logging.FileHandler('logs/latest.log', encoding='utf-8')  # 输出到文件
+        RotatingFileHandler('logs/latest.log', maxBytes=50_000_000, backupCount=5, encoding='utf-8')  # 输出到文件，50MB轮换
     ]
-)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # 真正的写入在后台线程里做，请求线程记日志只是往队列里放一条记录
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    _root.setLevel(logging.INFO)
+    _root.addHandler(QueueHandler(log_queue))
+
+
+_root = logging.getLogger()
+# 本模块被用不同路径重复导入时不要再挂一套handler，否则每条日志输出两遍
+if not any(isinstance(handler, QueueHandler) for handler in _root.handlers):
+    _setup()
 
-logger = logging.getLogger('prompt_api')
\ No newline at end of file
+logger = logging.getLogger('prompt_api')
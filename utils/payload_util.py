@@ -1,87 +1,85 @@
-from managers.ai_manager import ai_manager
+from functools import lru_cache
+from pathlib import Path
+
 from managers.prompt_manager import prompt_manager
 from utils.logger import logger
 import time
 
-compression_prompt = """# 智能对话压缩器
-
-## 任务
-分析对话，智能判断是否适合压缩，生成简洁总结。
+# 压缩任务的说明文字放在同目录的compression_prompt.txt里，第一次压缩时才读进来
+COMPRESSION_PROMPT_FILE = Path(__file__).with_name("compression_prompt.txt")
 
-## 压缩策略
-✅ **立即压缩**（看到这些信号就压缩）：
-- 话题明显切换（"对了"、"换个话题"）
-- 任务完成（"搞定"、"谢谢"、"明白了"）
-- 工作转闲聊（代码写完→聊天气/吃饭）
-- 多轮讨论已结束（已给最终方案）
+@lru_cache(maxsize=None)
+def _get_compression_prompt() -> str:
+    return COMPRESSION_PROMPT_FILE.read_text(encoding="utf-8").rstrip("\n")
 
-❌ **不压缩**（看到这些就调用no_compress）：
-- 正在工作（"调试中"、"让我试试"、"还在"）
-- 连续追问中（连续问相关问题的第1-3轮）
-- 刚刚得到建议还没回应
+def convert_context(context: list) -> list:
+    """
+    把历史消息转换成发给AI的格式(只保留接口需要的字段)
+    :param context: 历史消息(archive + tactical)
+    :return: 接口格式的消息列表
+    """
+    converted = [None] * len(context)
+    missing_ts = None  # 占位id用的时间戳，整批只取一次
+
+    for i, msg in enumerate(context):
+        msg_role = msg.get("role")
+
+        if msg_role is None:
+            # archive里的压缩记忆没有role，作为system消息放进上下文
+            message_item = {"role": "system", "content": msg.get("content", "")}
+        elif msg_role == "tool":
+            # tool 消息必须包含 tool_call_id
+            tool_call_id = msg.get("tool_call_id")
+            if not tool_call_id:
+                # 如果上下文中没有tool_call_id，添加一个占位符
+                if missing_ts is None:
+                    missing_ts = int(time.time())
+                # 带上下标，同一批里的多个占位id也不会重复
+                tool_call_id = f"call_missing_{missing_ts}_{i}"
+                logger.warning("上下文中的tool消息缺少tool_call_id，使用占位符: %s", tool_call_id)
+            message_item = {"role": "tool", "content": msg["content"], "tool_call_id": tool_call_id}
+        elif msg_role == "assistant" and msg.get("tool_calls"):
+            # assistant 且有工具调用
+            message_item = {"role": "assistant", "content": msg["content"], "tool_calls": msg["tool_calls"]}
+        else:
+            message_item = {"role": msg_role, "content": msg["content"]}
 
-## 总结要求
-- 1-2句话，30字左右
-- 抓核心：做了什么事，得到什么结果
-- 重要代码功能、关键决策、工具结果
+        converted[i] = message_item
 
-## 示例
-✅ "用户完成了登录模块开发，开始聊周末计划"
-✅ "讨论完Python装饰器原理，用户表示感谢"
-❌ 不压缩：用户刚收到代码建议，正在尝试
+    return converted
 
-**核心原则**：能压就压，但别压断当前思路！"""
+@lru_cache(maxsize=64)
+def _compression_system_prompt(system_prompt: str) -> str:
+    """压缩任务用的系统提示词(原prompt + 压缩说明)，按prompt内容缓存，prompt改了自然就是新的key"""
+    return system_prompt + "\n\n" + _get_compression_prompt()
 
-def build_messages(system_prompt: str, context: list, messages: list, role: str, device: str):
-    final = []
+def build_messages(system_prompt: str, context: list, messages: list, role: str, device: str, is_compression: bool = False):
+    # 一次分配好整个列表，按下标填入
+    final = [None] * ((2 if system_prompt else 1) + len(context) + len(messages))
+    i = 0
 
     if system_prompt:
-        if "压缩任务" in device:
-            final.append({
-                "role": "system",
-                "content": system_prompt + "\n\n" + compression_prompt
-            })
-        else:
-            final.append({
-                "role": "system",
-                "content": system_prompt
-            })
-
-    if "压缩任务" in device:
-        final.append({
-            "role": "system",
-            "content": f"【压缩任务】{device}"
-        })
-    else:
-        final.append({
+        final[i] = {
             "role": "system",
-            "content": f"【当前设备】{device}"
-        })
-
-    for msg in context:
-        message_item = {
-            "role": msg["role"],
-            "content": msg["content"]
+            "content": _compression_system_prompt(system_prompt) if is_compression else system_prompt
         }
+        i += 1
 
-        # 如果是 assistant 且有工具调用
-        if msg["role"] == "assistant" and msg.get("tool_calls"):
-            message_item["tool_calls"] = msg["tool_calls"]
+    # 顺序: 固定的系统提示词 -> 历史上下文 -> 设备标记 -> 本轮新消息
+    # 会变的设备标记放在历史后面，前面这一大段前缀每轮都一样，上游的前缀缓存才能命中
+    final[i:i + len(context)] = context
+    i += len(context)
 
-        # 如果是 tool 消息，必须包含 tool_call_id
-        if msg["role"] == "tool" and msg.get("tool_call_id"):
-            message_item["tool_call_id"] = msg["tool_call_id"]
-        elif msg["role"] == "tool":
-            # 如果上下文中没有tool_call_id，添加一个占位符
-            message_item["tool_call_id"] = f"call_missing_{int(time.time())}"
-            logger.warning(f"上下文中的tool消息缺少tool_call_id，使用占位符: {message_item['tool_call_id']}")
-        final.append(message_item)
+    final[i] = {
+        "role": "system",
+        "content": f"【压缩任务】{device}" if is_compression else f"【当前设备】{device}"
+    }
+    i += 1
 
     for m in messages:
-        final.append({
-            "role": role,
-            "content": m
-        })
+        # 字符串按role包装，已经转换好的消息(dict)原样放入
+        final[i] = m if isinstance(m, dict) else {"role": role, "content": m}
+        i += 1
 
     return final
 
@@ -97,35 +95,38 @@ def generate_openai_payload(
     """
     生成OpenAI格式的payload
     :param prompt_type: 使用的Prompt的identifier(存储在Prompt里)
-    :param messages: 新消息
+    :param messages: 新消息(字符串按role包装, 已经转换好的消息dict原样放入)
     :param role: role
-    :param context: 上下文
+    :param context: 上下文(已经用convert_context转换过)
     :param ai: 正在使用的ai的配置文件
     :param device: 正在使用的设备(正在使用的用户)
-    :param tools: 可用Tools
+    :param tools: 可用Tools(list或已序列化的json_util.RawJSON)
     :return:
     """
     system_prompt = prompt_manager.get_full_prompt(prompt_type)
+    # device包含"压缩任务"时是压缩请求，只判断这一次
+    is_compression = "压缩任务" in device
 
     final_messages = build_messages(
         system_prompt=system_prompt,
         context=context,
         messages=messages,
         role=role,
-        device=device
+        device=device,
+        is_compression=is_compression
     )
 
-    payload = {
-        "model": ai["model"],
-        "messages": final_messages,
-        "temperature": ai.get("temperature", 0.7),
-        "top_p": ai.get("top_p", 1.0),
-        "max_tokens": ai.get("max_tokens", 1024),
-        "stream": ai.get("stream", False),
-    }
+    if system_prompt and ai.get("cache_control"):
+        # 系统提示词每轮都一样，标记出来让上游缓存这段前缀(Claude需要显式标记)，设备等会变的内容在它后面
+        final_messages[0] = {
+            "role": "system",
+            "content": [{"type": "text", "text": final_messages[0]["content"], "cache_control": {"type": "ephemeral"}}]
+        }
 
-    # 检查是否包含"压缩任务"
-    if "压缩任务" in device:
+    payload = _openai_payload_base(ai).copy()
+    payload["messages"] = final_messages
+
+    if is_compression:
         payload["temperature"] = 0.3  # 压缩任务需要更确定性
         payload["max_tokens"] = 1000  # 限制压缩输出的长度
 
@@ -134,42 +135,76 @@ def generate_openai_payload(
         # 某些模型可能需要显式设置tool_choice为"auto"或"required"
         payload["tool_choice"] = ai.get("tool_choice", "auto")
 
+    return payload
+
+# 最多缓存多少份ai配置的固定payload
+PAYLOAD_BASE_CACHE_SIZE = 64
+
+# id(ai配置) -> (ai配置, payload里只由配置决定的部分)
+# 缓存里保存着配置本身，只要还在缓存里它的id就不会被别的对象复用；ai_manager改配置时是整份替换，不会原地修改
+_payload_bases = {}
+
+def _openai_payload_base(ai: dict) -> dict:
+    """OpenAI格式payload里不随请求变化的字段，每份ai配置只算一次(用的时候copy)"""
+    cached = _payload_bases.get(id(ai))
+    if cached is not None and cached[0] is ai:
+        return cached[1]
+
+    base = {
+        "model": ai["model"],
+        "messages": None,
+        "temperature": ai.get("temperature", 0.7),
+        "top_p": ai.get("top_p", 1.0),
+        "max_tokens": ai.get("max_tokens", 1024),
+        "stream": ai.get("stream", False),
+    }
+
     # seed 不是所有家都有，但 OpenAI / DeepSeek 支持
     if ai.get("seed") is not None:
-        payload["seed"] = ai["seed"]
+        base["seed"] = ai["seed"]
 
-    return payload
+    if len(_payload_bases) >= PAYLOAD_BASE_CACHE_SIZE:
+        _payload_bases.clear()
+    _payload_bases[id(ai)] = (ai, base)
+    return base
+
+# provider -> payload生成函数
+_PAYLOAD_BUILDERS = {
+    "openai": generate_openai_payload,
+    "deepseek": generate_openai_payload,
+    "ollama": generate_openai_payload,
+    "siliconflow": generate_openai_payload,
+}
 
 def generate_payload(
             prompt_type,
             messages,
             role,
             context,
-            ai,
+            ai_config,
         device,
     tools = None):
     """
     生成用于AI的json payload
     :param prompt_type: 使用的Prompt的identifier(存储在Prompt里)
-    :param messages: 新消息
+    :param messages: 新消息(字符串按role包装, 已经转换好的消息dict原样放入)
     :param role: role
-    :param context: 上下文
-    :param ai: 正在使用的ai的UUID
+    :param context: 上下文(已经用convert_context转换过)
+    :param ai_config: 正在使用的ai的配置(已经从ai_manager取出)
     :param device: 正在使用的设备
-    :param tools: 可用Tools
+    :param tools: 可用Tools(list或已序列化的json_util.RawJSON)
     :return:
     """
-    ai = ai_manager.get(ai)
-    payload = {}
-
-    if ai["provider"] in ("openai", "deepseek", "ollama", "siliconflow"):
-        payload = generate_openai_payload(
-            prompt_type,
-            messages,
-            role,
-            context,
-            ai,
-            device,
-            tools
-        )
-    return payload
\ No newline at end of file
+    builder = _PAYLOAD_BUILDERS.get(ai_config["provider"])
+    if builder is None:
+        return {}
+
+    return builder(
+        prompt_type,
+        messages,
+        role,
+        context,
+        ai_config,
+        device,
+        tools
+    )
\ No newline at end of file
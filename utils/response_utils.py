@@ -1,4 +1,21 @@
-from flask import jsonify
+from flask import current_app
+
+from utils.json_util import dumps
+
+# 状态码 -> 没有提供原因时的默认错误原因
+_DEFAULT_CAUSES = {
+    400: "Missing one or more fields",
+    403: "Invalid API key",
+    422: "Malformed parameter",
+}
+
+# 最常见的几种响应体内容固定，导入时序列化一次
+# 只缓存bytes，Response对象每次请求还是新建(after_request等可能会改它的headers)
+_EMPTY_OK_BODY = dumps({"success": True, "data": {}})
+_DEFAULT_ERROR_BODIES = {
+    status: dumps({"success": False, "cause": cause}) for status, cause in _DEFAULT_CAUSES.items()
+}
+
 
 class ResponseUtil:
     """响应工具类"""
@@ -13,15 +30,25 @@ class ResponseUtil:
         Returns:
             (json_response, 200)
         """
+        return ResponseUtil.raw(ResponseUtil.success_body(data))
+
+    @staticmethod
+    def success_body(data = None) -> bytes:
+        """序列化成功响应的响应体（可缓存后交给raw返回）"""
         if data is None:
-            data = {}
+            return _EMPTY_OK_BODY
 
         response = {
             "success": True,
             "data": data
         }
 
-        return jsonify(response), 200
+        return dumps(response)
+
+    @staticmethod
+    def raw(body: bytes, http_status: int = 200) -> tuple:
+        """直接返回已序列化好的JSON响应体"""
+        return current_app.response_class(body, mimetype="application/json"), http_status
 
     @staticmethod
     def error(http_status: int, cause: str = None) -> tuple:
@@ -39,18 +66,14 @@ class ResponseUtil:
         """
         # 如果没有提供原因，根据状态码自动生成
         if cause is None:
-            if http_status == 400:
-                cause = "Missing one or more fields"
-            elif http_status == 403:
-                cause = "Invalid API key"
-            elif http_status == 422:
-                cause = "Malformed parameter"
-            else:
-                cause = "InternalError"
+            body = _DEFAULT_ERROR_BODIES.get(http_status)
+            if body is not None:
+                return ResponseUtil.raw(body, http_status)
+            cause = "InternalError"
 
         response = {
             "success": False,
             "cause": cause
         }
 
-        return jsonify(response), http_status
+        return ResponseUtil.raw(dumps(response), http_status)